@@ -0,0 +1,171 @@
+import os
+import re
+import sqlite3
+import threading
+
+
+ANSWER_END_MARKER = "****************************************************************************************\n" \
+                    "****************************************************************************************"
+# Answer lines that start like the end marker, after any escaping backslashes. In the answer files, one more
+# backslash is put in front of them, so that an answer never contains the marker (as ">From " in mbox files)
+MARKER_LINE_REGEX = re.compile(r"^(\\*\*{88})", re.MULTILINE)
+ESCAPED_MARKER_LINE_REGEX = re.compile(r"^\\(\\*\*{88})", re.MULTILINE)
+
+
+class AnswerStore:
+    """
+    Answers of the LLMs per question, in an SQLite file keyed by exam, lang, llm and question Index.
+    Each answer directory (llm_out, llm_out_filtered) has its own store, <dir>/answers.sqlite. The answer files
+    (<exam>_<lang>_<llm>.txt) stay the exchange format: they are imported into the store when they are newer than at
+    their last import, so that edited files are picked up.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self.connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers (exam TEXT, lang TEXT, llm TEXT, question TEXT, answer TEXT, "
+                "PRIMARY KEY (exam, lang, llm, question)) WITHOUT ROWID"
+            )
+            self.connection.execute("CREATE TABLE IF NOT EXISTS imported_files (path TEXT PRIMARY KEY, mtime REAL)")
+            self.connection.commit()
+        return self.connection
+
+    def put_answers(self, exam, lang, llm, answers, source_path=None):
+        """
+        Replace all answers of the LLM to the exam
+        :param answers: dict question Index -> answer
+        :param source_path: answer file holding the same answers, recorded as imported
+        """
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                # Questions that are no longer in the answers (e.g. removed from the exam) are cleared
+                connection.execute("DELETE FROM answers WHERE exam = ? AND lang = ? AND llm = ?", (exam, lang, llm))
+                connection.executemany(
+                    "INSERT INTO answers VALUES (?, ?, ?, ?, ?)",
+                    [(exam, lang, llm, question_id, answer) for question_id, answer in answers.items()]
+                )
+                if source_path is not None:
+                    connection.execute("INSERT OR REPLACE INTO imported_files VALUES (?, ?)",
+                                       (os.path.abspath(source_path), os.path.getmtime(source_path)))
+
+    def get_answer(self, exam, lang, llm, question_id):
+        """
+        :return: the answer, or None if it is not in the store
+        """
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT answer FROM answers WHERE exam = ? AND lang = ? AND llm = ? AND question = ?",
+                (exam, lang, llm, question_id)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def get_answers(self, exam, lang, llm):
+        """
+        :return: dict question Index -> answer of all answers of the LLM to the exam
+        """
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT question, answer FROM answers WHERE exam = ? AND lang = ? AND llm = ?", (exam, lang, llm)
+            ).fetchall()
+        return dict(rows)
+
+    def import_answer_file(self, path, exam, lang, llm):
+        """
+        Import an answer file in the marker-delimited format, unless it was not modified since its last import
+        """
+        if not os.path.isfile(path):
+            return
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            row = self.connect().execute("SELECT mtime FROM imported_files WHERE path = ?",
+                                         (os.path.abspath(path),)).fetchone()
+        if row is not None and row[0] == mtime:
+            return
+        with open(path, 'r') as f:
+            answers = parse_answer_file(f.read())
+        self.put_answers(exam, lang, llm, answers, source_path=path)
+
+    def load_answers(self, exam, lang, llm, answer_file=None):
+        """
+        :param answer_file: answer file of the LLM, imported first if it changed
+        :return: dict question Index -> answer
+        """
+        if answer_file is not None:
+            self.import_answer_file(answer_file, exam, lang, llm)
+        return self.get_answers(exam, lang, llm)
+
+
+ANSWER_STORES = {}
+ANSWER_STORES_LOCK = threading.Lock()
+
+
+def answer_store(answer_dir):
+    """
+    :param answer_dir: e.g. llm_out or llm_out_filtered
+    :return: the AnswerStore of the directory, shared within the process
+    """
+    with ANSWER_STORES_LOCK:
+        if answer_dir not in ANSWER_STORES:
+            ANSWER_STORES[answer_dir] = AnswerStore(f"{answer_dir}/answers.sqlite")
+        return ANSWER_STORES[answer_dir]
+
+
+def format_answer_file(question_ids, answers):
+    """
+    :param question_ids: question Indexes in exam order
+    :return: the answers in the marker-delimited format of the answer files. Answer lines that start like the end
+    marker are escaped, see `parse_answer_file`
+    """
+    exam_out = ''
+    for question_id in question_ids:
+        exam_out += f"Answer to Question {question_id}\n"
+        exam_out += f"{escape_answer(answers[question_id])}\n"
+        exam_out += f"\n\n\n\n\n{ANSWER_END_MARKER}\n\n\n\n\n"
+    return exam_out
+
+
+def parse_answer_file(text):
+    """
+    Parse an answer file in a single pass over the end markers
+    :return: dict question Index -> answer
+    """
+    answers = {}
+    start_marker = "Answer to Question "
+    for part in text.split(ANSWER_END_MARKER)[:-1]:
+        start_index = part.find(start_marker)
+        if start_index == -1:
+            continue
+        end_of_line = part.find('\n', start_index)
+        if end_of_line == -1:
+            continue
+        question_id = part[start_index + len(start_marker):end_of_line]
+        answer = part[end_of_line + 1:]
+        # Layout written by format_answer_file: the answer, a newline, then five newlines before the end marker
+        if answer.endswith("\n\n\n\n\n\n"):
+            answer = answer[:-len("\n\n\n\n\n\n")]
+        answers[question_id] = unescape_answer(answer)
+    return answers
+
+
+def escape_answer(answer):
+    return MARKER_LINE_REGEX.sub(r"\\\1", answer)
+
+
+def unescape_answer(answer):
+    return ESCAPED_MARKER_LINE_REGEX.sub(r"\1", answer)
+
+
+def marker_answer_text(answer):
+    """
+    :return: the answer with the text between its "Answer to Question" line and its end marker in an answer file
+    (see `format_answer_file`), as the grading prompts have always inserted it
+    """
+    return f"\n{answer}\n\n\n\n\n\n"
@@ -0,0 +1,132 @@
+import json
+import os
+import time
+from utils import load_json, dump_json, info_from_exam_path, process_images
+from llm_solve_exam import solve_requests
+from llm_grade_exam import grading_jobs
+
+
+# Limits of one batch file, below those of the OpenAI Batch API and the Anthropic Message Batches API
+BATCH_MAX_REQUESTS = 10000
+BATCH_MAX_BYTES = 150 * 1024 ** 2
+
+
+def collect_requests(task, exam_json_paths, llm_name, nr_shots=0, shot_type="same_question", with_ref='no'):
+    """
+    :return: generator of (exam_json_path, request) for the requests that `solve_exam` or `grade_exam` would send
+    """
+    for exam_json_path in exam_json_paths:
+        try:
+            if task == 'solve':
+                for request in solve_requests(exam_json_path, llm_name):
+                    yield exam_json_path, request
+            elif task == 'grade':
+                for job in grading_jobs(exam_json_path, llm_name, nr_shots=nr_shots, shot_type=shot_type,
+                                        with_ref=with_ref):
+                    for request in job["requests"]:
+                        yield exam_json_path, request
+            else:
+                raise RuntimeError(f"Task {task} not implemented.")
+        except SystemExit:
+            # e.g. missing human grades, see sciex.run_skippable
+            print(f"Skipped exam at {exam_json_path}")
+
+
+def keyed_requests(llm_client, requests, figure_max_megapixels=None):
+    """
+    :param llm_client: a CachedClient. Its cache key of a request is the custom id of the request in the batch
+    :return: generator of (exam_json_path, key, images, request)
+    """
+    for exam_json_path, request in requests:
+        exam_name, _ = info_from_exam_path(exam_json_path)
+        # Same figures as sent by FigurePrefetcher, so that the keys match when the run is replayed
+        images = []
+        if llm_client.consumes_images:
+            images = process_images(exam_name, request["question"], image_policy=llm_client.image_policy,
+                                    max_megapixels=figure_max_megapixels)
+        key = llm_client.request_key(request["prompt"], request["input_body"], images, **request["kwargs"])
+        yield exam_json_path, key, images, request
+
+
+def write_batch_files(llm_client, requests, path_prefix, figure_max_megapixels=None):
+    """
+    Write the requests that are not in the response cache to JSONL batch files <path_prefix>_<part>.jsonl
+    :return: paths of the batch files
+    """
+    batch_paths = []
+    seen_keys = set()
+    f = None
+    nr_requests, nr_bytes = 0, 0
+    try:
+        for _, key, images, request in keyed_requests(llm_client, requests, figure_max_megapixels):
+            if key in seen_keys or llm_client.response_cache.get(key) is not None:
+                continue
+            seen_keys.add(key)
+            body = llm_client.build_request_body(request["prompt"], request["input_body"], images, **request["kwargs"])
+            line = json.dumps(llm_client.batch_line(key, body)) + '\n'
+
+            if f is None or nr_requests >= BATCH_MAX_REQUESTS or nr_bytes + len(line) > BATCH_MAX_BYTES:
+                if f is not None:
+                    f.close()
+                batch_paths.append(f"{path_prefix}_{len(batch_paths)}.jsonl")
+                f = open(batch_paths[-1], 'w')
+                nr_requests, nr_bytes = 0, 0
+            f.write(line)
+            nr_requests += 1
+            nr_bytes += len(line)
+    finally:
+        if f is not None:
+            f.close()
+    print(f"Wrote {len(seen_keys)} requests to {len(batch_paths)} batch files")
+    return batch_paths
+
+
+def run_batch(llm_client, collect, batch_dir, name, figure_max_megapixels=None, poll_interval=60):
+    """
+    Send the requests of a run as batches and store the results in the response cache of the client.
+    The batch ids are kept in <batch_dir>/<name>_state.json, so an interrupted run resumes polling its batches.
+    :param llm_client: CachedClient of a backend with batch support (openai, claude)
+    :param collect: function returning a new generator of the (exam_json_path, request) of the run
+    :return: the exams with requests that are still not answered, e.g. because they failed in the batch
+    """
+    if not hasattr(llm_client, 'submit_batch'):
+        raise RuntimeError("Batch mode is only supported by clients with a batch API (openai, claude)")
+    os.makedirs(batch_dir, exist_ok=True)
+    state_path = f"{batch_dir}/{name}_state.json"
+    state = load_json(state_path) if os.path.isfile(state_path) else {"batches": []}
+
+    if all(batch["done"] for batch in state["batches"]):
+        batch_paths = write_batch_files(llm_client, collect(), f"{batch_dir}/{name}", figure_max_megapixels)
+        state = {"batches": []}
+        for batch_path in batch_paths:
+            batch_id = llm_client.submit_batch(batch_path)
+            print(f"Submitted {batch_path} as batch {batch_id}")
+            state["batches"].append({"path": batch_path, "id": batch_id, "done": False})
+            dump_json(state, state_path)
+    else:
+        print(f"Resuming the batches in {state_path}")
+
+    while True:
+        for batch in state["batches"]:
+            if batch["done"]:
+                continue
+            results = llm_client.batch_results(batch["id"])
+            if results is None:
+                continue
+            for key, out in results.items():
+                llm_client.response_cache.put(key, out, request=llm_client.cache_params())
+            batch["done"] = True
+            dump_json(state, state_path)
+            print(f"Batch {batch['id']} ended: {len(results)} results")
+
+        nr_running = sum(not batch["done"] for batch in state["batches"])
+        if nr_running == 0:
+            break
+        print(f"Waiting for {nr_running} batches ...")
+        time.sleep(poll_interval)
+
+    return set(
+        exam_json_path
+        for exam_json_path, key, _, _ in keyed_requests(llm_client, collect(), figure_max_megapixels)
+        if llm_client.response_cache.get(key) is None
+    )
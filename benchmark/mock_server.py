@@ -0,0 +1,344 @@
+"""
+Mock LLM server for benchmarks: answers OpenAI chat completions (/v1/chat/completions) and text-generation-inference
+requests (/, /generate, /generate_stream) after a configurable latency, fails a configurable share of the requests,
+and returns canned responses of a configurable shape. No model and no network access are needed.
+Stands in for the batch APIs used by `sciex.py batch` too: the OpenAI files and batches API (/v1/files,
+/v1/batches, /v1/batches/{id}, /v1/files/{id}/content) and the Anthropic Message Batches API (/v1/messages/batches,
+/v1/messages/batches/{id}, /v1/messages/batches/{id}/results). A batch ends after the latency.
+Usage (from the repository root): python -m benchmark.mock_server [--port 8089] [--latency 0.5] [--error-rate 0.05]
+Then run the drivers with e.g. --server-type openai --server-url http://127.0.0.1:8089/v1
+or --server-type hf_text_gen --server-url http://127.0.0.1:8089,
+or python sciex.py batch solve --server-type openai --server-url http://127.0.0.1:8089/v1 --batch-poll-interval 1
+"""
+import argparse
+import email.policy
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+RESPONSE_SHAPES = {
+    # Short answer, parsed as a grade of 1 point by parse_grade
+    'answer': "The answer is 1, as shown by the derivation above.",
+    # Grading output in the format requested by grading_prompt_prefix
+    'grade': "The answer is partially correct. [grade] 1 [/grade]",
+    # About 1000 tokens
+    'long': " ".join(["The answer needs a longer derivation."] * 150) + " [grade] 1 [/grade]",
+    # Grading output without a grade
+    'unparsable': "I can not grade this answer.",
+}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    # Set by `main`
+    latency = 0.5
+    latency_jitter = 0.0
+    error_rate = 0.0
+    response_text = RESPONSE_SHAPES['answer']
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+
+    # Uploaded files and submitted batches, shared by all handler threads
+    files = {}
+    batches = {}
+    store_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = self.path.rstrip('/')
+        # Batch API routes: answered at once, the batch ends after the latency
+        if path.endswith('/messages/batches'):
+            self.create_claude_batch(json.loads(content))
+            return
+        if path.endswith('/files'):
+            self.upload_file(content)
+            return
+        if path.endswith('/batches'):
+            self.create_openai_batch(json.loads(content))
+            return
+
+        body = json.loads(content or b'{}')
+        delay, failed = self.draw_request()
+        time.sleep(delay)
+
+        if failed:
+            # Overloaded server: retried by RetryClient. error_type is read by text_generation.Client
+            self.send_json(503, {"error": {"message": "Mock server overloaded", "type": "server_error"},
+                                 "error_type": "overloaded"},
+                           headers={"Retry-After": "0"})
+            return
+
+        nr_tokens = len(self.response_text.split())
+        if path.endswith('/chat/completions'):
+            self.send_json(200, self.chat_completion(body))
+        elif path.endswith('/generate'):
+            self.send_json(200, self.generate_response(nr_tokens))
+        elif path.endswith('/generate_stream'):
+            self.send_stream()
+        elif path == '':
+            # text_generation.Client posts to the base URL and sets "stream" in the body
+            if body.get("stream"):
+                self.send_stream()
+            else:
+                self.send_json(200, [self.generate_response(nr_tokens)])
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        match = re.search(r'/messages/batches/([^/]+)(/results)?$', path)
+        if match is not None:
+            with self.store_lock:
+                batch = self.batches.get(match.group(1))
+            if batch is None:
+                self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+            elif match.group(2) is not None:
+                self.send_content(200, batch["output"], 'application/binary')
+            else:
+                self.send_json(200, self.claude_batch_status(batch))
+            return
+        match = re.search(r'/files/([^/]+)/content$', path)
+        if match is not None:
+            with self.store_lock:
+                content = self.files.get(match.group(1))
+            if content is None:
+                self.send_json(404, {"error": {"message": f"No file {match.group(1)}"}})
+            else:
+                self.send_content(200, content, 'application/binary')
+            return
+        match = re.search(r'/batches/([^/]+)$', path)
+        if match is not None:
+            with self.store_lock:
+                batch = self.batches.get(match.group(1))
+            if batch is None:
+                self.send_json(404, {"error": {"message": f"No batch {match.group(1)}"}})
+            else:
+                self.send_json(200, self.openai_batch_status(batch))
+            return
+        self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def draw_request(self):
+        """
+        :return: (response time in seconds, whether the request fails)
+        """
+        with self.rng_lock:
+            delay = max(0.0, self.rng.gauss(self.latency, self.latency_jitter))
+            failed = self.rng.random() < self.error_rate
+        return delay, failed
+
+    def chat_completion(self, body):
+        nr_tokens = len(self.response_text.split())
+        nr_input_characters = sum(len(json.dumps(message["content"])) for message in body.get("messages", []))
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.response_text},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": nr_input_characters // 4,
+                "completion_tokens": nr_tokens,
+                "total_tokens": nr_input_characters // 4 + nr_tokens
+            }
+        }
+
+    def claude_message(self, params):
+        nr_input_characters = len(params.get("system", "")) + sum(
+            len(json.dumps(message["content"])) for message in params.get("messages", []))
+        return {
+            "id": "msg_mock",
+            "type": "message",
+            "role": "assistant",
+            "model": params.get("model", "mock"),
+            "content": [{"type": "text", "text": self.response_text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": nr_input_characters // 4, "output_tokens": len(self.response_text.split())}
+        }
+
+    def upload_file(self, content):
+        """
+        Store the file of a multipart/form-data upload (OpenAI files API)
+        """
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + content)
+        file_part = next(part for part in message.iter_parts()
+                         if part.get_param('name', header='content-disposition') == 'file')
+        data = file_part.get_payload(decode=True)
+        with self.store_lock:
+            file_id = f"file-mock-{len(self.files)}"
+            self.files[file_id] = data
+        self.send_json(200, {
+            "id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+            "filename": file_part.get_filename() or "batch.jsonl", "purpose": "batch", "status": "processed"
+        })
+
+    def create_openai_batch(self, body):
+        with self.store_lock:
+            lines = [json.loads(line) for line in self.files[body["input_file_id"]].splitlines() if line.strip()]
+        output_lines = []
+        nr_failed = 0
+        for i, line in enumerate(lines):
+            _, failed = self.draw_request()
+            if failed:
+                nr_failed += 1
+                response = {"status_code": 503, "request_id": f"req-mock-{i}",
+                            "body": {"error": {"message": "Mock server overloaded", "type": "server_error"}}}
+            else:
+                response = {"status_code": 200, "request_id": f"req-mock-{i}",
+                            "body": self.chat_completion(line["body"])}
+            output_lines.append(json.dumps({"id": f"batch-req-mock-{i}", "custom_id": line["custom_id"],
+                                            "response": response, "error": None}))
+        with self.store_lock:
+            batch_id = f"batch-mock-{len(self.batches)}"
+            output_file_id = f"file-mock-{len(self.files)}"
+            self.files[output_file_id] = ("\n".join(output_lines) + "\n").encode('utf-8')
+            self.batches[batch_id] = {
+                "id": batch_id, "created_at": time.time(), "ended_at": time.time() + self.latency,
+                "input_file_id": body["input_file_id"], "endpoint": body["endpoint"],
+                "completion_window": body["completion_window"], "output_file_id": output_file_id,
+                "nr_requests": len(lines), "nr_failed": nr_failed
+            }
+            batch = self.batches[batch_id]
+        self.send_json(200, self.openai_batch_status(batch))
+
+    def openai_batch_status(self, batch):
+        ended = time.time() >= batch["ended_at"]
+        return {
+            "id": batch["id"],
+            "object": "batch",
+            "endpoint": batch["endpoint"],
+            "input_file_id": batch["input_file_id"],
+            "completion_window": batch["completion_window"],
+            "status": "completed" if ended else "in_progress",
+            "output_file_id": batch["output_file_id"] if ended else None,
+            "created_at": int(batch["created_at"]),
+            "request_counts": {
+                "total": batch["nr_requests"],
+                "completed": batch["nr_requests"] - batch["nr_failed"] if ended else 0,
+                "failed": batch["nr_failed"] if ended else 0
+            }
+        }
+
+    def create_claude_batch(self, body):
+        output_lines = []
+        nr_failed = 0
+        for request in body["requests"]:
+            _, failed = self.draw_request()
+            if failed:
+                nr_failed += 1
+                result = {"type": "errored",
+                          "error": {"type": "error", "error": {"type": "overloaded_error",
+                                                               "message": "Mock server overloaded"}}}
+            else:
+                result = {"type": "succeeded", "message": self.claude_message(request["params"])}
+            output_lines.append(json.dumps({"custom_id": request["custom_id"], "result": result}))
+        with self.store_lock:
+            batch_id = f"msgbatch_mock_{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id, "created_at": time.time(), "ended_at": time.time() + self.latency,
+                "output": ("\n".join(output_lines) + "\n").encode('utf-8'),
+                "results_url": f"http://{self.headers.get('Host')}/v1/messages/batches/{batch_id}/results",
+                "nr_requests": len(body["requests"]), "nr_failed": nr_failed
+            }
+            batch = self.batches[batch_id]
+        self.send_json(200, self.claude_batch_status(batch))
+
+    def claude_batch_status(self, batch):
+        ended = time.time() >= batch["ended_at"]
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else batch["nr_requests"],
+                "succeeded": batch["nr_requests"] - batch["nr_failed"] if ended else 0,
+                "errored": batch["nr_failed"] if ended else 0,
+                "canceled": 0,
+                "expired": 0
+            },
+            "created_at": iso_timestamp(batch["created_at"]),
+            "ended_at": iso_timestamp(batch["ended_at"]) if ended else None,
+            "expires_at": iso_timestamp(batch["created_at"] + 24 * 3600),
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": batch["results_url"] if ended else None
+        }
+
+    def generate_response(self, nr_tokens):
+        return {
+            "generated_text": self.response_text,
+            "details": {"finish_reason": "eos_token", "generated_tokens": nr_tokens, "seed": None,
+                        "prefill": [], "tokens": []}
+        }
+
+    def send_stream(self):
+        """
+        Send the response text as server-sent events, one token per word
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        words = self.response_text.split(' ')
+        for i, word in enumerate(words):
+            token = {"id": i, "text": word if i == 0 else f" {word}", "logprob": 0.0, "special": False}
+            event = {"token": token, "generated_text": self.response_text if i == len(words) - 1 else None,
+                     "details": None}
+            self.wfile.write(f"data:{json.dumps(event)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+    def send_json(self, status, obj, headers=None):
+        self.send_content(status, json.dumps(obj).encode('utf-8'), 'application/json', headers=headers)
+
+    def send_content(self, status, content, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def iso_timestamp(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat()
+
+
+def add_mock_server_arguments(parser):
+    parser.add_argument("--latency", default=0.5, type=float, help="Mean response time in seconds")
+    parser.add_argument("--latency-jitter", default=0.1, type=float, help="Standard deviation of the response time")
+    parser.add_argument("--error-rate", default=0.0, type=float, help="Share of the requests failing with 503")
+    parser.add_argument("--response-shape", default='grade', choices=list(RESPONSE_SHAPES.keys()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8089, type=int)
+    add_mock_server_arguments(parser)
+    args = parser.parse_args()
+
+    MockLLMHandler.latency = args.latency
+    MockLLMHandler.latency_jitter = args.latency_jitter
+    MockLLMHandler.error_rate = args.error_rate
+    MockLLMHandler.response_text = RESPONSE_SHAPES[args.response_shape]
+
+    server = ThreadingHTTPServer((args.host, args.port), MockLLMHandler)
+    print(f"Mock LLM server listening on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
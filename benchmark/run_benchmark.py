@@ -0,0 +1,162 @@
+"""
+End-to-end throughput benchmark of the pipeline against the mock LLM server (benchmark/mock_server.py):
+generates synthetic exams with figures, runs llm_solve_exam.py and llm_grade_exam.py on them, and reports per stage
+the questions/s, the p50/p95 request latency, the peak RSS and the CPU time of the driver processes.
+With a mock latency of 0, the numbers are the overhead of the pipeline itself.
+Usage (from the repository root): python -m benchmark.run_benchmark [--latency 0.2] [--max-concurrency 8]
+    [--extra-args="--prefetch-workers 2"]
+"""
+import argparse
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from benchmark.mock_server import add_mock_server_arguments
+from benchmark.synthetic_exam import create_synthetic_exams, add_synthetic_exam_arguments
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ['solve', 'grade']
+
+
+def start_mock_server(args, port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmark.mock_server", "--port", str(port), "--latency", str(args.latency),
+         "--latency-jitter", str(args.latency_jitter), "--error-rate", str(args.error_rate),
+         "--response-shape", args.response_shape],
+        cwd=REPO_DIR
+    )
+    # Wait until the server accepts connections
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Mock server did not start on port {port}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_process(command, cwd, env):
+    """
+    :return: wall time, peak RSS in MB and CPU time (user + system) in seconds of the process
+    """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    # Let Popen know that the process was reaped
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.perf_counter() - start_time
+    if process.returncode != 0:
+        raise RuntimeError(f"{shlex.join(command)} failed with exit code {process.returncode}")
+    return wall_time, rusage.ru_maxrss / 1024, rusage.ru_utime + rusage.ru_stime
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def run_stage(stage, exam_json_paths, args, server_url, workdir, env):
+    """
+    Run the driver of the stage once per exam, as the shell scripts used to
+    :return: dict of the measurements of the stage
+    """
+    telemetry_log = f"{workdir}/telemetry_{stage}.jsonl"
+    script = "llm_solve_exam.py" if stage == 'solve' else "llm_grade_exam.py"
+    wall_time, peak_rss, cpu_time = 0.0, 0.0, 0.0
+    for exam_json_path in exam_json_paths:
+        command = [
+            sys.executable, f"{REPO_DIR}/{script}",
+            "--server-type", args.server_type, "--server-url", server_url,
+            "--llm-name-full", args.llm_name_full, "--llm-name", "benchmark",
+            "--exam-json-path", exam_json_path, "--telemetry-log", telemetry_log,
+            "--max-retries", "5", "--retry-base-delay", "0.05", "--max-concurrency", str(args.max_concurrency),
+        ] + shlex.split(args.extra_args)
+        process_wall_time, process_peak_rss, process_cpu_time = run_process(command, workdir, env)
+        wall_time += process_wall_time
+        peak_rss = max(peak_rss, process_peak_rss)
+        cpu_time += process_cpu_time
+
+    records = []
+    if os.path.isfile(telemetry_log):
+        with open(telemetry_log) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    latencies = [record["latency"] for record in records]
+    return {
+        "stage": stage,
+        "questions": len(records),
+        "wall_time": wall_time,
+        "questions_per_second": len(records) / wall_time if wall_time > 0 else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "peak_rss_mb": peak_rss,
+        "cpu_time": cpu_time,
+        "retries": sum(record.get("retries", 0) for record in records),
+    }
+
+
+def format_value(value, fmt):
+    return "-" if value is None else format(value, fmt)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", default=None,
+                        help="Directory of the synthetic exams and the outputs. Default: a new temporary directory")
+    parser.add_argument("--server-type", default='openai', choices=['openai', 'hf_text_gen', 'hf_text_gen_async'])
+    parser.add_argument("--llm-name-full", default="mock-vision",
+                        help="Model name sent to the mock server. For openai, 'vision' in the name sends the figures")
+    parser.add_argument("--max-concurrency", default=1, type=int)
+    parser.add_argument("--stages", nargs='*', default=STAGES, choices=STAGES)
+    parser.add_argument("--extra-args", default="", help="Further arguments of the drivers, e.g. '--prefetch-workers 0'")
+    parser.add_argument("--output", default=None, help="JSON file receiving the results")
+    add_synthetic_exam_arguments(parser)
+    add_mock_server_arguments(parser)
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="sciex_benchmark_")
+    workdir = os.path.abspath(workdir)
+    print(f"Working directory: {workdir}")
+    exam_json_paths = create_synthetic_exams(workdir, nr_exams=args.nr_exams, nr_questions=args.nr_questions,
+                                             figure_ratio=args.figure_ratio, pages_per_figure=args.pages_per_figure)
+    if os.path.isdir(f"{REPO_DIR}/artifacts") and not os.path.exists(f"{workdir}/artifacts"):
+        # Font of the figure titles
+        os.symlink(f"{REPO_DIR}/artifacts", f"{workdir}/artifacts")
+
+    env = {**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "mock")}
+    port = free_port()
+    server = start_mock_server(args, port)
+    server_url = f"http://127.0.0.1:{port}/v1" if args.server_type == 'openai' else f"http://127.0.0.1:{port}"
+    try:
+        results = [run_stage(stage, exam_json_paths, args, server_url, workdir, env) for stage in args.stages]
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{'stage':<8} {'questions':>9} {'wall s':>8} {'q/s':>8} {'p50 s':>7} {'p95 s':>7} "
+          f"{'peak RSS MB':>11} {'CPU s':>7} {'retries':>7}")
+    for result in results:
+        print(f"{result['stage']:<8} {result['questions']:>9} {result['wall_time']:>8.2f} "
+              f"{format_value(result['questions_per_second'], '>8.2f')} {format_value(result['latency_p50'], '>7.3f')} "
+              f"{format_value(result['latency_p95'], '>7.3f')} {result['peak_rss_mb']:>11.1f} "
+              f"{result['cpu_time']:>7.2f} {result['retries']:>7}")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
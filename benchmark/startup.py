@@ -0,0 +1,59 @@
+"""
+Measure the startup time of the non-HF backends: a fresh interpreter that imports llm_clients and the SDK of
+one --server-type. Exits with an error if a backend exceeds the target or pulls in transformers/torch.
+Usage (from the repository root): python -m benchmark.startup [--target-seconds 1.0]
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+
+STARTUP_TARGET_SECONDS = 1.0
+NON_HF_SERVER_TYPES = ['openai', 'claude', 'hf_text_gen']
+
+STARTUP_CODE = """
+import sys
+from llm_clients import CLIENT_REGISTRY
+CLIENT_REGISTRY[{server_type!r}].import_backend()
+heavy_modules = [module for module in ('transformers', 'torch', 'fitz') if module in sys.modules]
+if heavy_modules:
+    raise SystemExit(f"Heavy modules imported: {{heavy_modules}}")
+"""
+
+
+def measure_startup(code, repeats):
+    """
+    :return: the best wall time in seconds of running `code` in a fresh interpreter
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target-seconds", default=STARTUP_TARGET_SECONDS, type=float)
+    parser.add_argument("--repeats", default=5, type=int)
+    args = parser.parse_args()
+
+    interpreter_time = measure_startup("pass", args.repeats)
+    print(f"{'interpreter':<15} {interpreter_time:.3f}s")
+
+    too_slow = []
+    for server_type in NON_HF_SERVER_TYPES:
+        startup_time = measure_startup(STARTUP_CODE.format(server_type=server_type), args.repeats)
+        print(f"{server_type:<15} {startup_time:.3f}s")
+        if startup_time > args.target_seconds:
+            too_slow.append(server_type)
+
+    if len(too_slow) > 0:
+        raise SystemExit(f"Startup of {too_slow} exceeds the target of {args.target_seconds}s")
+    print(f"All non-HF backends start within {args.target_seconds}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Generate synthetic exams in the layout of the repository (exams_json/, human_feedback/, llm_out_filtered/),
+with figure PDFs, so that the solve and grade drivers can be benchmarked without the real exams.
+Usage (from the repository root): python -m benchmark.synthetic_exam --root <dir> [--nr-exams 2] [--nr-questions 20]
+"""
+import argparse
+import json
+import os
+import random
+from PIL import Image, ImageDraw
+from utils import LLM_LIST, dump_json
+from answer_store import format_answer_file
+
+
+def create_figure(path, rng, nr_pages=1, width=1240, height=1754):
+    """
+    Write a PDF with `nr_pages` A4 pages (150 dpi) of random shapes
+    """
+    pages = []
+    for _ in range(nr_pages):
+        page = Image.new('RGB', (width, height), 'white')
+        draw = ImageDraw.Draw(page)
+        for _ in range(30):
+            x0, y0 = rng.randrange(width - 100), rng.randrange(height - 100)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.rectangle((x0, y0, x0 + rng.randrange(20, 400), y0 + rng.randrange(20, 400)), outline=color, width=4)
+        draw.text((50, 50), f"Synthetic figure {os.path.basename(path)}", fill='black')
+        pages.append(page)
+    pages[0].save(path, "PDF", save_all=True, append_images=pages[1:])
+
+
+def create_synthetic_exam(root, exam_name, lang='en', nr_questions=20, figure_ratio=0.3, pages_per_figure=1, seed=0):
+    """
+    Write the exam, its figures, the additional info (maximum points, gold answers), one answer file per LLM of
+    LLM_LIST and the human grades of these answers
+    :return: path of the exam JSON, relative to root
+    """
+    rng = random.Random(seed)
+    exam_dir = f"{root}/exams_json/{exam_name}"
+    os.makedirs(exam_dir, exist_ok=True)
+
+    questions = []
+    for q in range(nr_questions):
+        question = {
+            "Index": str(q + 1),
+            "Description": f"Question {q + 1}: " + " ".join(
+                rng.choice(["Explain", "derive", "the", "gradient", "of", "a", "network", "and", "why", "it",
+                            "converges", "under", "which", "assumptions"]) for _ in range(rng.randrange(20, 80))
+            ),
+        }
+        if rng.random() < figure_ratio:
+            figure_name = f"figure_{q + 1}.pdf"
+            create_figure(f"{exam_dir}/{figure_name}", rng, nr_pages=pages_per_figure)
+            question["Figures"] = [figure_name]
+        questions.append(question)
+    exam_json_path = f"exams_json/{exam_name}/{exam_name}_{lang}.json"
+    dump_json({"Questions": questions}, f"{root}/{exam_json_path}")
+
+    feedback_dir = f"{root}/human_feedback/{exam_name}"
+    os.makedirs(f"{feedback_dir}/grades", exist_ok=True)
+    dump_json({"Questions": [{
+        "Index": question["Index"],
+        "MaximumPoints": 2,
+        "GoldAnswerEnglish": "The gradient vanishes, hence the network converges.",
+        "GoldAnswerGerman": "Der Gradient verschwindet, daher konvergiert das Netz."
+    } for question in questions]}, f"{feedback_dir}/additional_info.json")
+
+    answers_dir = f"{root}/llm_out_filtered/{exam_name}"
+    os.makedirs(answers_dir, exist_ok=True)
+    for llm_id in range(len(LLM_LIST)):
+        # Written by the same function as the answer files of the solve driver
+        exam_out = format_answer_file(
+            [question['Index'] for question in questions],
+            {question['Index']: f"The answer of {LLM_LIST[llm_id]} to question {question['Index']}."
+             for question in questions}
+        )
+        with open(f"{answers_dir}/{exam_name}_{lang}_llm{llm_id}.txt", 'w') as f:
+            f.write(exam_out)
+        dump_json({"Questions": [{"Index": question["Index"], "Points": rng.choice([0, 1, 2])}
+                                 for question in questions]},
+                  f"{feedback_dir}/grades/{exam_name}_{lang}_llm{llm_id}_grade.json")
+    return exam_json_path
+
+
+def create_synthetic_exams(root, nr_exams=2, nr_questions=20, figure_ratio=0.3, pages_per_figure=1):
+    """
+    :return: paths of the exam JSON files, relative to root
+    """
+    return [
+        create_synthetic_exam(root, f"synthetic_{i}", nr_questions=nr_questions, figure_ratio=figure_ratio,
+                              pages_per_figure=pages_per_figure, seed=i)
+        for i in range(nr_exams)
+    ]
+
+
+def add_synthetic_exam_arguments(parser):
+    parser.add_argument("--nr-exams", default=2, type=int)
+    parser.add_argument("--nr-questions", default=20, type=int)
+    parser.add_argument("--figure-ratio", default=0.3, type=float, help="Share of the questions with a figure")
+    parser.add_argument("--pages-per-figure", default=1, type=int)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", required=True, help="Directory the exams are written to")
+    add_synthetic_exam_arguments(parser)
+    args = parser.parse_args()
+
+    exam_json_paths = create_synthetic_exams(args.root, nr_exams=args.nr_exams, nr_questions=args.nr_questions,
+                                             figure_ratio=args.figure_ratio, pages_per_figure=args.pages_per_figure)
+    print(json.dumps(exam_json_paths, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,11 @@ def main():
 
     args = parser.parse_args()
 
-    exam = load_json(args.json_path)
+    create_grading_template(args.json_path)
+
+
+def create_grading_template(json_path):
+    exam = load_json(json_path)
 
     questions = []
     for question in exam['Questions']:
@@ -22,12 +26,12 @@ def main():
 
     out_template = {"Questions": questions, "TotalPoints": None, "TotalGradeGermanScale": None}
 
-    exam_name = args.json_path.split('/')[-2]
+    exam_name = json_path.split('/')[-2]
     out_dir = f"human_feedback_template/{exam_name}/grades"
     os.makedirs(out_dir, exist_ok=True)
 
     for llm in LLM_LIST:
-        filename = args.json_path.split('/')[-1].replace('.json', f'_{map_llm_to_index(llm)}_grade.json')
+        filename = json_path.split('/')[-1].replace('.json', f'_{map_llm_to_index(llm)}_grade.json')
         dump_json(out_template, f"{out_dir}/{filename}")
 
 
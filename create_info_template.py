@@ -10,7 +10,11 @@ def main():
 
     args = parser.parse_args()
 
-    exam = load_json(args.json_path)
+    create_info_template(args.json_path)
+
+
+def create_info_template(json_path):
+    exam = load_json(json_path)
 
     questions = []
     for question in exam['Questions']:
@@ -28,7 +32,7 @@ def main():
                     "AverageStudentTotalPoints": None,
                     "MedianStudentGradeGermanScale": None}
 
-    exam_name = args.json_path.split('/')[-2]
+    exam_name = json_path.split('/')[-2]
     out_dir = f"human_feedback_template/{exam_name}"
     os.makedirs(out_dir, exist_ok=True)
     dump_json(out_template, f"{out_dir}/additional_info.json")
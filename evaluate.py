@@ -0,0 +1,316 @@
+import argparse
+import time
+import warnings
+from grade_store import grade_store, GRADE_STORE_PATH, HUMAN_GRADER
+from utils import LLM_LIST
+
+
+# Names of the LLMs in the leaderboard of the README
+LLM_DISPLAY_NAMES = {
+    'llava': 'Llava', 'mistral': 'Mistral', 'mixtral': 'Mixtral', 'qwen': 'Qwen', 'claude': 'Claude',
+    'gpt35': 'GPT-3.5', 'gpt4v': 'GPT-4V', 'o1-mini': 'o1-mini'
+}
+
+
+def main():
+    """
+    Compute the leaderboard of the README from the grade store (python grade_store.py import):
+    solve-exam performance (average grade percentage across exams, expert and automatically graded) and grade-exam
+    performance (Pearson and Spearman correlation of the grades of each LLM grader with the expert grades), with
+    bootstrap confidence intervals.
+    Usage: python evaluate.py [--grader-config 0_shot] [--auto-grader gpt4v] [--nr-resamples 1000] [--per-exam]
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=GRADE_STORE_PATH)
+    parser.add_argument("--grader-config", default="0_shot",
+                        help="Shot config of the LLM grades, i.e. the directory below grader_<name>/, "
+                             "e.g. 2_shot_with_ref/same_exam_shot")
+    parser.add_argument("--auto-grader", default="gpt4v", help="Grader of the automatically graded solve-exam column")
+    parser.add_argument("--nr-resamples", default=1000, type=int, help="Bootstrap resamples. 0 to disable the CIs")
+    parser.add_argument("--confidence", default=0.95, type=float)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--per-exam", action='store_true', help="Also print the grade percentage per exam")
+    parser.add_argument("--output", default=None, help="Markdown file receiving the tables")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    store = grade_store(args.db)
+    store.import_files()
+    grades = load_grade_array(store, args.grader_config)
+    tables = [leaderboard_table(grades, args.auto_grader, nr_resamples=args.nr_resamples,
+                                confidence=args.confidence, seed=args.seed)]
+    if args.per_exam:
+        tables.append(per_exam_table(grades, [HUMAN_GRADER, args.auto_grader]))
+    output = "\n\n".join(tables)
+    print(output)
+    print(f"Computed in {time.time() - start_time:.3f}s")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+
+def load_grade_array(store, grader_config):
+    """
+    Load all grades into an exam x lang x candidate x question x grader array
+    :param grader_config: shot config of the LLM grades, the human grades have no config
+    :return: dict with "points" (nan where not graded or not parsed), "max_points" (exam x question) and the labels
+    of the axes: "exams", "langs", "llms", "graders"
+    """
+    import numpy as np
+    table = store.grade_table()
+    keep = (table["grader"] == HUMAN_GRADER) | (table["config"] == grader_config)
+    table = {name: column[keep] for name, column in table.items()}
+
+    exams, exam_ids = np.unique(table["exam"].astype(str), return_inverse=True)
+    langs, lang_ids = np.unique(table["lang"].astype(str), return_inverse=True)
+    llms, llm_ids = np.unique(table["llm"].astype(str), return_inverse=True)
+    graders, grader_ids = np.unique(table["grader"].astype(str), return_inverse=True)
+    # Questions are numbered per exam: the unique (exam, question) pairs are sorted by exam
+    exam_questions, exam_question_ids = np.unique(
+        np.char.add(np.char.add(table["exam"].astype(str), "\0"), table["question"].astype(str)), return_inverse=True
+    )
+    exam_of_question = np.array([x.split("\0")[0] for x in exam_questions])
+    first_question = np.searchsorted(exam_of_question, exams)
+    question_ids = exam_question_ids - first_question[exam_ids]
+    nr_questions = int(question_ids.max()) + 1 if len(question_ids) > 0 else 0
+
+    points = np.full((len(exams), len(langs), len(llms), nr_questions, len(graders)), np.nan)
+    points[exam_ids, lang_ids, llm_ids, question_ids, grader_ids] = table["points"]
+    max_points = np.full((len(exams), nr_questions), np.nan)
+    max_points[exam_ids, question_ids] = table["max_points"]
+    return {"points": points, "max_points": max_points, "exams": list(exams), "langs": list(langs),
+            "llms": list(llms), "graders": list(graders)}
+
+
+def exam_percentages(grades):
+    """
+    :return: exam x lang x candidate x grader array of the grade percentage, i.e. the points divided by the maximum
+    points of the graded questions (nan if no question is graded)
+    """
+    import numpy as np
+    max_points = grades["max_points"][:, None, None, :, None]
+    graded = ~np.isnan(grades["points"]) & (max_points > 0)
+    total_points = np.where(graded, grades["points"], 0).sum(axis=3)
+    total_max_points = np.where(graded, max_points, 0).sum(axis=3)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total_max_points > 0, 100 * total_points / total_max_points, np.nan)
+
+
+def normalized_grades(grades):
+    """
+    :return: the points divided by the maximum points of the question, same shape as grades["points"]
+    """
+    import numpy as np
+    max_points = grades["max_points"][:, None, None, :, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(max_points > 0, grades["points"] / max_points, np.nan)
+
+
+def bootstrap_counts(n, nr_resamples, rng):
+    """
+    :return: nr_resamples x n array of how often each of the n units is drawn in each resample. Row 0 is the
+    original sample (all ones), so that the statistics of the sample and of the resamples are computed together
+    """
+    import numpy as np
+    counts = rng.multinomial(n, np.full(n, 1 / n), size=nr_resamples) if n > 0 else np.zeros((nr_resamples, 0))
+    return np.vstack([np.ones((1, n)), counts])
+
+
+def weighted_pearson(x, y, weights):
+    """
+    :param x, y: arrays of n values, or of one row of n values per weight row
+    :param weights: resamples x n array of weights (bootstrap counts)
+    :return: the Pearson correlation per row of weights
+    """
+    import numpy as np
+    total = weights.sum(axis=1, keepdims=True)
+    x_mean = (weights * x).sum(axis=1, keepdims=True) / total
+    y_mean = (weights * y).sum(axis=1, keepdims=True) / total
+    covariance = (weights * (x - x_mean) * (y - y_mean)).sum(axis=1)
+    variance = (weights * (x - x_mean) ** 2).sum(axis=1) * (weights * (y - y_mean) ** 2).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(variance > 0, covariance / np.sqrt(variance), np.nan)
+
+
+def weighted_midranks(values, weights):
+    """
+    Ranks of the values in each weighted sample, tied values getting the mean of their ranks: what ranking each
+    bootstrap resample (a value drawn k times counting k times) would give, without sorting each resample
+    :param values: array of n values
+    :param weights: resamples x n array of weights (bootstrap counts)
+    :return: resamples x n array of the ranks
+    """
+    import numpy as np
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+    group_weights = np.add.reduceat(weights[:, order], group_starts, axis=1)
+    group_ranks = np.cumsum(group_weights, axis=1) - group_weights + (group_weights + 1) / 2
+    group_of_value = np.repeat(np.arange(len(group_starts)), np.diff(np.r_[group_starts, len(values)]))
+    ranks = np.empty(weights.shape)
+    ranks[:, order] = group_ranks[:, group_of_value]
+    return ranks
+
+
+def correlations(x, y, nr_resamples, rng):
+    """
+    Pearson and Spearman correlation of the (x, y) pairs and of nr_resamples bootstrap resamples of the pairs.
+    Grades take few distinct values, so the pairs are grouped into cells of equal (x, y): drawing n pairs with
+    replacement is drawing the cell counts from a multinomial distribution, and the statistics are computed on the
+    cells, whatever the number of pairs
+    :return: Pearson and Spearman correlation, each with the statistic of the original sample in row 0
+    """
+    import numpy as np
+    cells, cell_sizes = np.unique(np.stack([x, y], axis=1), axis=0, return_counts=True)
+    weights = np.vstack([cell_sizes[None, :], rng.multinomial(len(x), cell_sizes / len(x), size=nr_resamples)])
+    pearson = weighted_pearson(cells[:, 0], cells[:, 1], weights)
+    spearman = weighted_pearson(weighted_midranks(cells[:, 0], weights), weighted_midranks(cells[:, 1], weights),
+                                weights)
+    return pearson, spearman
+
+
+def confidence_interval(samples, confidence):
+    """
+    :param samples: statistic of the original sample (row 0) and of the resamples, along the first axis
+    :return: lower and upper percentile bound along the first axis, nan without resamples
+    """
+    import numpy as np
+    if samples.shape[0] <= 1:
+        return np.full(samples.shape[1:], np.nan), np.full(samples.shape[1:], np.nan)
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        # Statistics that are nan in all resamples, e.g. the correlation with a constant grader
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(samples[1:], 100 * alpha, axis=0), np.nanpercentile(samples[1:], 100 * (1 - alpha), axis=0)
+
+
+def solve_scores(grades, nr_resamples=1000, seed=0):
+    """
+    Average grade percentage across exams per candidate LLM and grader, with the exams (exam, lang) resampled
+    :return: (1 + nr_resamples) x candidate x grader array, row 0 being the scores of the original sample
+    """
+    import numpy as np
+    percentages = exam_percentages(grades)
+    nr_exams, nr_langs, nr_llms, nr_graders = percentages.shape
+    percentages = percentages.reshape(nr_exams * nr_langs, nr_llms * nr_graders)
+    graded = ~np.isnan(percentages)
+    counts = bootstrap_counts(nr_exams * nr_langs, nr_resamples, np.random.default_rng(seed))
+    # Mean over the graded exams of each resample, for all candidates and graders in two matrix products
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = (counts @ np.where(graded, percentages, 0)) / (counts @ graded)
+    return scores.reshape(-1, nr_llms, nr_graders)
+
+
+def grader_correlations(grades, nr_resamples=1000, seed=0):
+    """
+    Correlation of the normalized grades of each grader with the human grades, over all graded
+    (exam, lang, candidate, question), resampled with replacement
+    :return: dict grader -> (pearson, spearman), each with the statistic of the original sample in row 0
+    """
+    import numpy as np
+    if HUMAN_GRADER not in grades["graders"]:
+        return {}
+    normalized = normalized_grades(grades).reshape(-1, len(grades["graders"]))
+    human = normalized[:, grades["graders"].index(HUMAN_GRADER)]
+    rng = np.random.default_rng(seed)
+    results = {}
+    for g, grader in enumerate(grades["graders"]):
+        if grader == HUMAN_GRADER:
+            continue
+        both = ~np.isnan(normalized[:, g]) & ~np.isnan(human)
+        if both.sum() < 2:
+            continue
+        results[grader] = correlations(normalized[both, g], human[both], nr_resamples, rng)
+    return results
+
+
+def leaderboard_table(grades, auto_grader, nr_resamples=1000, confidence=0.95, seed=0):
+    """
+    :return: the leaderboard in markdown, the LLMs sorted first by the expert grade, then by the automatic grade
+    """
+    import numpy as np
+    scores = solve_scores(grades, nr_resamples=nr_resamples, seed=seed)
+    lower, upper = confidence_interval(scores, confidence)
+    grader_stats = grader_correlations(grades, nr_resamples=nr_resamples, seed=seed)
+
+    def score_cell(llm, grader):
+        if grader not in grades["graders"]:
+            return "-"
+        c, g = grades["llms"].index(llm), grades["graders"].index(grader)
+        return format_statistic(scores[0, c, g], lower[c, g], upper[c, g], "{:.1f}")
+
+    def correlation_cell(llm, statistic):
+        if llm not in grader_stats:
+            return "-"
+        samples = grader_stats[llm][statistic]
+        bounds = confidence_interval(samples[:, None], confidence)
+        return format_statistic(samples[0], bounds[0][0], bounds[1][0], "{:.3f}")
+
+    llms = sorted(set(grades["llms"]) | set(grader_stats.keys()),
+                  key=lambda llm: LLM_LIST.index(llm) if llm in LLM_LIST else len(LLM_LIST))
+
+    def sort_key(llm):
+        keys = []
+        for grader in [HUMAN_GRADER, auto_grader]:
+            score = scores[0, grades["llms"].index(llm), grades["graders"].index(grader)] \
+                if llm in grades["llms"] and grader in grades["graders"] else np.nan
+            keys.append(-score if not np.isnan(score) else np.inf)
+        return keys
+    llms = sorted(llms, key=sort_key)
+
+    auto_name = LLM_DISPLAY_NAMES.get(auto_grader, auto_grader)
+    ci = f" [{int(confidence * 100)}% CI]" if nr_resamples > 0 else ""
+    lines = [
+        f"| No. | LLM | Solve-Exam Performance* (Expert graded){ci} | Solve-Exam Performance* ({auto_name} graded){ci} "
+        f"| Grade-Exam Performance** (Pearson){ci} | Grade-Exam Performance** (Spearman){ci} |",
+        "|-----|-----|:---:|:---:|:---:|:---:|"
+    ]
+    for i, llm in enumerate(llms):
+        lines.append(
+            f"| {i + 1} | {LLM_DISPLAY_NAMES.get(llm, llm)} | {score_cell(llm, HUMAN_GRADER) if llm in grades['llms'] else '-'} "
+            f"| {score_cell(llm, auto_grader) if llm in grades['llms'] else '-'} "
+            f"| {correlation_cell(llm, 0)} | {correlation_cell(llm, 1)} |"
+        )
+    lines += [
+        "",
+        "*: Solve-exam performance is measured by the average grade percentage across exams.",
+        "",
+        "**: Grade-exam performance is measured by the correlation between the grades provided by the LLMs and "
+        "grades provided by the experts."
+    ]
+    return "\n".join(lines)
+
+
+def per_exam_table(grades, graders):
+    """
+    :return: markdown table of the grade percentage per exam, candidate LLM and grader
+    """
+    import numpy as np
+    percentages = exam_percentages(grades)
+    graders = [grader for grader in graders if grader in grades["graders"]]
+    lines = [
+        "| Exam | Lang | Grader | " + " | ".join(LLM_DISPLAY_NAMES.get(llm, llm) for llm in grades["llms"]) + " |",
+        "|------|------|--------|" + "|".join(":---:" for _ in grades["llms"]) + "|"
+    ]
+    for e, exam in enumerate(grades["exams"]):
+        for l, lang in enumerate(grades["langs"]):
+            for grader in graders:
+                row = percentages[e, l, :, grades["graders"].index(grader)]
+                if np.all(np.isnan(row)):
+                    continue
+                lines.append(f"| {exam} | {lang} | {grader} | " +
+                             " | ".join("-" if np.isnan(x) else f"{x:.1f}" for x in row) + " |")
+    return "\n".join(lines)
+
+
+def format_statistic(value, lower, upper, fmt):
+    import numpy as np
+    if np.isnan(value):
+        return "-"
+    if np.isnan(lower) or np.isnan(upper):
+        return fmt.format(value)
+    return f"{fmt.format(value)} [{fmt.format(lower)}, {fmt.format(upper)}]"
+
+
+if __name__ == "__main__":
+    main()
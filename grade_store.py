@@ -0,0 +1,288 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from glob import glob
+from utils import LLM_LIST, load_json, dump_json, map_llm_to_index
+
+
+GRADE_STORE_PATH = "llm_grade/grades.sqlite"
+# Grader name of the grades in human_feedback/
+HUMAN_GRADER = "human"
+# Question fields kept in their own columns, the others are kept as JSON in the `extra` column
+PROMPT_KEY, OUTPUT_KEY, POINTS_KEY = "PromptInput", "FullOutput", "Points"
+
+
+class GradeStore:
+    """
+    LLM and human grades of all exams in one SQLite file, one row per question, keyed by exam, lang, candidate LLM,
+    grader, shot config (the directory below grader_<name>/, e.g. 2_shot_with_ref/same_exam_shot) and question Index.
+    The grading prompts are stored once per content hash: the instruction prefix with the shots is the same for all
+    questions of a config, and the input (question, answer) is the same for all graders.
+    The grade files stay the exchange format; `export_grades` writes them back in their layout.
+    """
+    def __init__(self, db_path=GRADE_STORE_PATH):
+        self.db_path = db_path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self.connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(
+                "CREATE TABLE IF NOT EXISTS grades (exam TEXT, lang TEXT, llm TEXT, grader TEXT, config TEXT, "
+                "question TEXT, position INTEGER, points REAL, prefix_hash TEXT, input_hash TEXT, full_output TEXT, "
+                "extra TEXT, PRIMARY KEY (exam, lang, llm, grader, config, question)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS prompts (hash TEXT PRIMARY KEY, text TEXT) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS grade_files (exam TEXT, lang TEXT, llm TEXT, grader TEXT, config TEXT, "
+                "fields TEXT, PRIMARY KEY (exam, lang, llm, grader, config)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS max_points (exam TEXT, question TEXT, position INTEGER, points REAL, "
+                "PRIMARY KEY (exam, question)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS imported_files (path TEXT PRIMARY KEY, mtime REAL);"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def put_grades(self, key, grades, source_path=None):
+        """
+        Replace the grades of one grade file
+        :param key: (exam, lang, llm, grader, config)
+        :param grades: content of the grade file ("Questions", "TotalPoints", ...)
+        :param source_path: grade file holding the same grades, recorded as imported
+        """
+        rows, prompts = [], {}
+        for position, question in enumerate(grades["Questions"]):
+            prefix_hash, input_hash = None, None
+            if question.get(PROMPT_KEY) is not None:
+                prefix, input_body = split_prompt(question[PROMPT_KEY])
+                input_hash = prompt_hash(input_body)
+                prompts[input_hash] = input_body
+                if prefix is not None:
+                    prefix_hash = prompt_hash(prefix)
+                    prompts[prefix_hash] = prefix
+            extra = {k: v for k, v in question.items() if k not in ["Index", PROMPT_KEY, OUTPUT_KEY, POINTS_KEY]}
+            points = question.get(POINTS_KEY)
+            if points is not None and not isinstance(points, float):
+                # e.g. "1,5" entered in grade_ui.py: the points column holds the number, extra the original value
+                extra[POINTS_KEY] = points
+                points = parse_points(points)
+            rows.append((*key, question["Index"], position, points, prefix_hash, input_hash,
+                         question.get(OUTPUT_KEY), json.dumps(extra, ensure_ascii=False)))
+        fields = {k: v for k, v in grades.items() if k != "Questions"}
+
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM grades WHERE exam = ? AND lang = ? AND llm = ? AND grader = ? "
+                                   "AND config = ?", key)
+                connection.executemany("INSERT OR IGNORE INTO prompts VALUES (?, ?)", list(prompts.items()))
+                connection.executemany("INSERT INTO grades VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                connection.execute("INSERT OR REPLACE INTO grade_files VALUES (?, ?, ?, ?, ?, ?)",
+                                   (*key, json.dumps(fields, ensure_ascii=False)))
+                if source_path is not None:
+                    connection.execute("INSERT OR REPLACE INTO imported_files VALUES (?, ?)",
+                                       (os.path.abspath(source_path), os.path.getmtime(source_path)))
+
+    def put_grade_file(self, path, grades=None):
+        """
+        Store the grades of a grade file of llm_grade/ or human_feedback/, keyed by its path
+        :param grades: content of the file, loaded if not given
+        """
+        self.put_grades(grade_file_key(path), load_json(path) if grades is None else grades, source_path=path)
+
+    def put_max_points(self, exam, additional_info, source_path=None):
+        rows = [
+            (exam, question["Index"], position, parse_points(question.get("MaximumPoints")))
+            for position, question in enumerate(additional_info["Questions"])
+        ]
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM max_points WHERE exam = ?", (exam,))
+                connection.executemany("INSERT INTO max_points VALUES (?, ?, ?, ?)", rows)
+                if source_path is not None:
+                    connection.execute("INSERT OR REPLACE INTO imported_files VALUES (?, ?)",
+                                       (os.path.abspath(source_path), os.path.getmtime(source_path)))
+
+    def is_imported(self, path):
+        with self.lock:
+            row = self.connect().execute("SELECT mtime FROM imported_files WHERE path = ?",
+                                         (os.path.abspath(path),)).fetchone()
+        return row is not None and row[0] == os.path.getmtime(path)
+
+    def import_files(self, llm_grade_dir="llm_grade", human_feedback_dir="human_feedback"):
+        """
+        Import the grade files and the maximum points, unless they were not modified since their last import
+        :return: number of imported files
+        """
+        paths = sorted(glob(f"{llm_grade_dir}/*/grader_*/**/*_grade.json", recursive=True)) + \
+            sorted(glob(f"{human_feedback_dir}/*/grades/*_grade.json"))
+        nr_imported = 0
+        for path in paths:
+            if not self.is_imported(path):
+                self.put_grade_file(path)
+                nr_imported += 1
+        for path in sorted(glob(f"{human_feedback_dir}/*/additional_info.json")):
+            if not self.is_imported(path):
+                self.put_max_points(path.split('/')[-2], load_json(path), source_path=path)
+                nr_imported += 1
+        return nr_imported
+
+    def grade_table(self, grader=None):
+        """
+        Load the grades for analysis, without the prompts and outputs
+        :param grader: only the grades of this grader, e.g. HUMAN_GRADER
+        :return: dict column -> numpy array, with the columns exam, lang, llm, grader, config, question, points and
+        max_points (nan where not available)
+        """
+        import numpy as np
+        query = "SELECT g.exam, g.lang, g.llm, g.grader, g.config, g.question, g.points, m.points " \
+                "FROM grades g LEFT JOIN max_points m ON g.exam = m.exam AND g.question = m.question"
+        params = ()
+        if grader is not None:
+            query += " WHERE g.grader = ?"
+            params = (grader,)
+        query += " ORDER BY g.exam, g.lang, g.llm, g.grader, g.config, g.position"
+        with self.lock:
+            rows = self.connect().execute(query, params).fetchall()
+        columns = list(zip(*rows)) if len(rows) > 0 else [()] * 8
+        table = {name: np.array(column, dtype=object)
+                 for name, column in zip(["exam", "lang", "llm", "grader", "config", "question"], columns)}
+        table["points"] = np.array([np.nan if x is None else x for x in columns[6]], dtype=np.float64)
+        table["max_points"] = np.array([np.nan if x is None else x for x in columns[7]], dtype=np.float64)
+        return table
+
+    def export_grades(self, out_dir):
+        """
+        Write all grades in the layout of the grade files: <out_dir>/llm_grade/<exam>/grader_<name>/<config>/... and
+        <out_dir>/human_feedback/<exam>/grades/...
+        :return: number of written files
+        """
+        with self.lock:
+            connection = self.connect()
+            files = connection.execute("SELECT exam, lang, llm, grader, config, fields FROM grade_files").fetchall()
+            prompts = dict(connection.execute("SELECT hash, text FROM prompts").fetchall())
+            rows = connection.execute(
+                "SELECT exam, lang, llm, grader, config, question, points, prefix_hash, input_hash, full_output, "
+                "extra FROM grades ORDER BY exam, lang, llm, grader, config, position"
+            ).fetchall()
+
+        questions = {}
+        for exam, lang, llm, grader, config, question_id, points, prefix_hash, input_hash, full_output, extra in rows:
+            question = {"Index": question_id}
+            if input_hash is not None:
+                question[PROMPT_KEY] = f"{prompts[prefix_hash]}\n{prompts[input_hash]}" if prefix_hash is not None \
+                    else prompts[input_hash]
+            extra = json.loads(extra)
+            original_points = extra.pop(POINTS_KEY, points)
+            question.update(extra)
+            if full_output is not None:
+                question[OUTPUT_KEY] = full_output
+            question[POINTS_KEY] = original_points
+            questions.setdefault((exam, lang, llm, grader, config), []).append(question)
+
+        for exam, lang, llm, grader, config, fields in files:
+            path = grade_file_path(out_dir, exam, lang, llm, grader, config)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            dump_json({"Questions": questions.get((exam, lang, llm, grader, config), []), **json.loads(fields)}, path)
+        return len(files)
+
+
+GRADE_STORES = {}
+GRADE_STORES_LOCK = threading.Lock()
+
+
+def grade_store(db_path=GRADE_STORE_PATH):
+    """
+    :return: the GradeStore of the file, shared within the process
+    """
+    with GRADE_STORES_LOCK:
+        if db_path not in GRADE_STORES:
+            GRADE_STORES[db_path] = GradeStore(db_path)
+        return GRADE_STORES[db_path]
+
+
+def split_prompt(prompt_input):
+    """
+    Split the PromptInput of a grade into the instruction prefix (with the shots) and the input of the question,
+    which starts at the last [question] block. Joined with a newline, the parts are the PromptInput again
+    :return: prefix (None if there is no [question] block) and input
+    """
+    split_index = prompt_input.rfind("\n[question]\n")
+    if split_index == -1:
+        return None, prompt_input
+    return prompt_input[:split_index], prompt_input[split_index + 1:]
+
+
+def parse_points(points):
+    """
+    :return: the points as float, None if they are not a number
+    """
+    if points is None:
+        return None
+    try:
+        return float(str(points).replace(',', '.'))
+    except ValueError:
+        return None
+
+
+def prompt_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def grade_file_key(path):
+    """
+    :return: (exam, lang, llm, grader, config) of a grade file of llm_grade/ or human_feedback/
+    """
+    parts = path.replace(os.sep, '/').split('/')
+    grader_positions = [i for i, part in enumerate(parts[:-1]) if part.startswith('grader_')]
+    if len(grader_positions) > 0 and grader_positions[-1] > 0:
+        grader_position = grader_positions[-1]
+        exam = parts[grader_position - 1]
+        grader = parts[grader_position][len('grader_'):]
+        config = '/'.join(parts[grader_position + 1:-1])
+    elif len(parts) >= 3 and parts[-2] == 'grades':
+        exam = parts[-3]
+        grader, config = HUMAN_GRADER, ""
+    else:
+        raise RuntimeError(f"Not a grade file path: {path}")
+
+    lang_llm = parts[-1][len(f"{exam}_"):-len("_grade.json")]
+    lang, llm = lang_llm.split('_', 1)
+    if grader == HUMAN_GRADER and llm.startswith('llm') and llm[3:].isdigit() and int(llm[3:]) < len(LLM_LIST):
+        # Human grade files name the LLMs by index
+        llm = LLM_LIST[int(llm[3:])]
+    return exam, lang, llm, grader, config
+
+
+def grade_file_path(root, exam, lang, llm, grader, config):
+    if grader == HUMAN_GRADER:
+        return f"{root}/human_feedback/{exam}/grades/{exam}_{lang}_{map_llm_to_index(llm)}_grade.json"
+    config_dir = f"{config}/" if config else ""
+    return f"{root}/llm_grade/{exam}/grader_{grader}/{config_dir}{exam}_{lang}_{llm}_grade.json"
+
+
+def main():
+    """
+    Usage: python grade_store.py import   to import the grade files of llm_grade/ and human_feedback/
+           python grade_store.py export --out-dir <dir>   to write all grades in the layout of the grade files
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=['import', 'export'])
+    parser.add_argument("--db", default=GRADE_STORE_PATH)
+    parser.add_argument("--out-dir", default="grade_export")
+    args = parser.parse_args()
+
+    store = grade_store(args.db)
+    if args.command == 'import':
+        print(f"Imported {store.import_files()} files into {args.db}")
+    else:
+        print(f"Exported {store.export_grades(args.out_dir)} grade files to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import os.path
 import streamlit as st
-from utils import load_json, map_llm_to_index, dump_json, load_images
+from utils import load_json, map_llm_to_index, map_index_to_llm, dump_json, FIGURE_CACHE
+from answer_store import answer_store
 from glob import glob
 
+# The figures are displayed again on every Streamlit rerun, so the UI keeps recently shown pages in memory
+FIGURE_CACHE.max_memory_bytes = 256 * 1024 ** 2
+
 
 def main():
     st.title('LLM exam grading')
@@ -38,8 +42,9 @@ def main():
                     if selected_llm.startswith('llm'):
                         answer_txt = f"llm_out_filtered/{exam_name}/{exam_name}_{exam_lang}_{selected_llm}.txt"
                         grade_json = f"human_feedback_streamlit/{exam_name}/grades/{exam_name}_{exam_lang}_{selected_llm}_grade.json"
-                        with open(answer_txt, "r") as file:
-                            answer = file.read()
+                        answers = answer_store("llm_out_filtered").load_answers(
+                            exam_name, exam_lang, map_index_to_llm(int(selected_llm[3:])), answer_file=answer_txt
+                        )
 
                     info_json = f"human_feedback_streamlit/{exam_name}/additional_info.json"
 
@@ -61,7 +66,9 @@ def main():
 
                         if selected_llm.startswith('llm'):
                             st.header(f"Answer to Question {question['Index']}:")
-                            st_write_lines(extract_answer(question['Index'], answer))
+                            if question['Index'] not in answers:
+                                raise RuntimeError(f"Problem with extracting answer for question {question['Index']}")
+                            st_write_lines(answers[question['Index']])
 
                             max_points = find_question(load_json(info_json)['Questions'], question['Index'])['MaximumPoints']
                             if max_points is None:
@@ -191,8 +198,7 @@ def does_contain_none(json_file):
 
 
 def display_image(path):
-    images, _ = load_images([path])
-    for image in images:
+    for image in FIGURE_CACHE.load(path):
         st.image(image, use_column_width="auto")
 
 
@@ -229,22 +235,6 @@ def find_question(questions, question_id):
     return None
 
 
-def extract_answer(question_id, answer):
-    start_marker = f"Answer to Question {question_id}"
-    end_marker = "****************************************************************************************\n" \
-                 "****************************************************************************************"
-
-    start_index = answer.find(start_marker)
-    if start_index == -1:
-        raise RuntimeError(f"Problem with extracting answer for question {question_id}")
-
-    end_index = answer.find(end_marker, start_index)
-    if end_index == -1:
-        raise RuntimeError(f"Problem with extracting answer for question {question_id}")
-
-    return answer[start_index + len(start_marker):end_index]
-
-
 def st_write_lines(txt):
     lines = txt.split('\n')
     for line in lines:
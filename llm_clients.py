@@ -1,15 +1,70 @@
-from openai import OpenAI
 from abc import ABC, abstractmethod
-from utils import encode_image, combine_images
-import anthropic
-import text_generation
+from utils import combine_images, image_digest, encode_images, ImagePolicy, OPENAI_IMAGE_POLICY, \
+    CLAUDE_IMAGE_POLICY
+from rate_limiter import RateLimiter, estimate_tokens
+from response_cache import ResponseCache, cache_key
+import asyncio
+import atexit
+import copy
+import email.utils
+import importlib.util
+import json
 import logging
-from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration
-from PIL import Image
+import queue
+import random
+import threading
 import time
+from PIL import Image
+from collections import OrderedDict
+
+
+# Maps --server-type to the LLMClient subclass. The SDK of each backend (openai, anthropic, text_generation,
+# transformers) is only imported by `import_backend` when a client of that type is created.
+# Each registered class creates its client from the parsed arguments (see `add_client_arguments`) with the
+# class method from_args(args).
+CLIENT_REGISTRY = {}
+
+
+def register_client(server_type):
+    def decorator(cls):
+        CLIENT_REGISTRY[server_type] = cls
+        return cls
+    return decorator
+
+
+REQUEST_STATS = threading.local()
+
+
+def request_stats():
+    """
+    :return: dict of statistics of the request currently sent by this thread, e.g. the time to first token
+    """
+    if not hasattr(REQUEST_STATS, 'stats'):
+        REQUEST_STATS.stats = {}
+    return REQUEST_STATS.stats
+
+
+def reset_request_stats():
+    REQUEST_STATS.stats = {}
+
+
+def add_request_stat(key, value):
+    stats = request_stats()
+    stats[key] = stats.get(key, 0) + value
 
 
 class LLMClient(ABC):
+    # Set by `create_client` if a requests/tokens per minute limit is given
+    rate_limiter = None
+    # How images are downscaled and encoded for the provider, see utils.ImagePolicy
+    image_policy = None
+    # False for clients that only send text: their requests are built without rendering the figures
+    consumes_images = True
+    # Set by `create_client` for --stream: receive the answer token by token. A request fails if no token arrives
+    # for stream_timeout seconds
+    stream = False
+    stream_timeout = 60
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -17,130 +72,657 @@ class LLMClient(ABC):
     def send_request(self, prompt, input_body, images, **kwargs):
         pass
 
+    def send_batch(self, requests):
+        """
+        Send several requests at once. Clients that can generate for several prompts in one call override this
+        :param requests: list of dicts with the arguments of `send_request`: "prompt", "input_body", "images", "kwargs"
+        :return: list of the outputs, in the order of the requests
+        """
+        return [
+            self.send_request(request["prompt"], request["input_body"], request["images"], **request["kwargs"])
+            for request in requests
+        ]
+
+    @staticmethod
+    def import_backend():
+        """
+        Import the heavy dependencies of the backend. Called when the client is created, not when this module is imported
+        """
+        pass
+
+    def get_stats(self):
+        """
+        :return: dict of counters collected during the run, e.g. the number of retries
+        """
+        return {}
 
+    def cache_params(self):
+        """
+        :return: dict of the client settings that determine the response, used in the response cache key
+        """
+        return {"client": type(self).__name__}
+
+    def wait_for_rate_limit(self, prompt, input_body, images, max_tokens):
+        """
+        Block until the request fits into the rate limit shared with the other threads and processes
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(estimate_tokens(prompt, input_body, images, max_tokens))
+
+    def encode_request_images(self, images):
+        """
+        :return: the images encoded with `encode_images` for the image policy of the client
+        """
+        encoded_images = encode_images(images, self.image_policy)
+        add_request_stat("images", len(encoded_images))
+        add_request_stat("image_bytes", sum(len(encoded_image) for encoded_image in encoded_images))
+        return encoded_images
+
+    def collect_stream(self, chunks, stream_to=None, count_tokens=True):
+        """
+        Consume a streamed answer: write the text chunks to `stream_to` as they arrive,
+        and record the time to first token and the tokens per second in the request stats
+        :param count_tokens: False if the client records the exact output tokens and tokens per second itself
+        :return: the full answer
+        """
+        start_time = time.time()
+        first_token_time = None
+        out_chunks = []
+        out_file = open(stream_to, 'w') if stream_to is not None else None
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.time()
+                out_chunks.append(chunk)
+                if out_file is not None:
+                    out_file.write(chunk)
+                    out_file.flush()
+        finally:
+            if out_file is not None:
+                out_file.close()
+        end_time = time.time()
+
+        if first_token_time is not None:
+            # Each streamed chunk is (roughly) one token
+            stats = request_stats()
+            stats["time_to_first_token"] = first_token_time - start_time
+            if count_tokens:
+                stats["tokens_per_second"] = len(out_chunks) / max(end_time - first_token_time, 1e-6)
+                add_request_stat("output_tokens", len(out_chunks))
+                print(f"**** Time to first token: {stats['time_to_first_token']:.2f}s, "
+                      f"{stats['tokens_per_second']:.1f} tokens/s")
+            else:
+                print(f"**** Time to first token: {stats['time_to_first_token']:.2f}s")
+        return ''.join(out_chunks)
+
+
+@register_client('openai')
 class OpenAIClient(LLMClient):
+    image_policy = OPENAI_IMAGE_POLICY
+
     def __init__(self, model, server_url="openai", seed=0):
         super(OpenAIClient, self).__init__()
+        OpenAI = self.import_backend()
         self.server_url = server_url
         self.model = model
         self.seed = seed
         if self.server_url != "openai":
-            self.client = OpenAI(base_url=self.server_url, timeout=900)
+            self.client = OpenAI(base_url=self.server_url, timeout=900, max_retries=0)
         else:
-            self.client = OpenAI(timeout=900)
+            self.client = OpenAI(timeout=900, max_retries=0)
 
-    def send_request(self, prompt, input_body, images, **kwargs):
-        time.sleep(1)
-        if "vision" in self.model:
+    @staticmethod
+    def import_backend():
+        from openai import OpenAI
+        return OpenAI
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(model=args.llm_name_full, server_url=args.server_url, seed=0)
+
+    def cache_params(self):
+        return {"client": type(self).__name__, "model": self.model, "seed": self.seed, "server_url": self.server_url,
+                "image_policy": self.image_policy.describe()}
+
+    @property
+    def consumes_images(self):
+        return "vision" in self.model
+
+    def build_request_body(self, prompt, input_body, images, **kwargs):
+        """
+        :return: body of the chat completion request, as sent to the API (also used for batch requests)
+        """
+        if self.consumes_images:
             images_messages = [
                 {
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/png;base64,{encode_image(pil_image=image)}"}
+                    "image_url": {"url": f"data:{self.image_policy.media_type};base64,{encoded_image}"}
                 }
-                for image in images
+                for encoded_image in self.encode_request_images(images)
             ]
             text_message = {
                 "type": "text",
                 "text": input_body
             }
             message = [text_message] + images_messages
-
-            response = self.client.chat.completions.create(
-                model=self.model,
-                seed=self.seed,
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": message}
-                ]
-            )
         else:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                seed=self.seed,
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": input_body}
-                ]
+            message = input_body
+        return {
+            "model": self.model,
+            "seed": self.seed,
+            "messages": [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": message}
+            ]
+        }
+
+    def send_request(self, prompt, input_body, images, **kwargs):
+        self.wait_for_rate_limit(prompt, input_body, images if self.consumes_images else [],
+                                 max_tokens=kwargs.get('max_tokens', 1000))
+        body = self.build_request_body(prompt, input_body, images, **kwargs)
+
+        if self.stream:
+            response = self.client.chat.completions.create(**body, stream=True, timeout=self.stream_timeout)
+            return self.collect_stream(
+                (chunk.choices[0].delta.content for chunk in response if len(chunk.choices) > 0),
+                stream_to=kwargs.get('stream_to')
             )
+
+        response = self.client.chat.completions.create(**body)
+        if response.usage is not None:
+            add_request_stat("input_tokens", response.usage.prompt_tokens)
+            add_request_stat("output_tokens", response.usage.completion_tokens)
         out = response.choices[0].message.content
         return out
 
+    def batch_line(self, custom_id, body):
+        return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+    def submit_batch(self, batch_path):
+        """
+        :param batch_path: JSONL file of `batch_line`s
+        :return: id of the batch
+        """
+        with open(batch_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        return batch.id
+
+    def batch_results(self, batch_id):
+        """
+        :return: None while the batch is running, then a dict custom_id -> output of the succeeded requests
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ['validating', 'in_progress', 'finalizing', 'cancelling']:
+            return None
+        if batch.status == 'failed':
+            raise RuntimeError(f"Batch {batch_id} failed: {batch.errors}")
+
+        # Expired or cancelled batches still have the results of the requests that were completed
+        results = {}
+        if batch.output_file_id is not None:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response")
+                if response is not None and response["status_code"] == 200:
+                    results[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        if len(results) < batch.request_counts.total:
+            print(f"Batch {batch_id} ({batch.status}): {batch.request_counts.total - len(results)} requests failed")
+        return results
+
 
+@register_client('claude')
 class ClaudeClient(LLMClient):
-    def __init__(self, model):
+    image_policy = CLAUDE_IMAGE_POLICY
+
+    def __init__(self, model, server_url=None):
+        """
+        :param server_url: None for the Anthropic API
+        """
         super(ClaudeClient, self).__init__()
-        self.client = anthropic.Anthropic()
+        anthropic = self.import_backend()
+        self.server_url = server_url
+        self.client = anthropic.Anthropic(base_url=server_url, max_retries=0)
         self.model = model
 
-    def send_request(self, prompt, input_body, images, **kwargs):
+    @staticmethod
+    def import_backend():
+        import anthropic
+        return anthropic
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(model=args.llm_name_full, server_url=args.server_url if args.server_url != "openai" else None)
+
+    def cache_params(self):
+        return {"client": type(self).__name__, "model": self.model, "temperature": 0.0, "max_tokens": 1000,
+                "server_url": self.server_url, "image_policy": self.image_policy.describe()}
+
+    def build_request_body(self, prompt, input_body, images, **kwargs):
+        """
+        :return: parameters of the messages request, as sent to the API (also used for batch requests)
+        """
         images_messages = [
             {
                 "type": "image",
                 "source": {
                     "type": "base64",
-                    "media_type": "image/png",
-                    "data": encode_image(pil_image=image)
+                    "media_type": self.image_policy.media_type,
+                    "data": encoded_image
                 }
             }
-            for image in images
+            for encoded_image in self.encode_request_images(images)
         ]
         text_message = {
             "type": "text",
             "text": input_body
         }
         message = images_messages + [text_message]
-
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=1000,
-            temperature=0.0,
-            system=prompt,
-            messages=[
+        return {
+            "model": self.model,
+            "max_tokens": 1000,
+            "temperature": 0.0,
+            "system": prompt,
+            "messages": [
                 {"role": "user", "content": message}
             ]
-        )
+        }
+
+    def send_request(self, prompt, input_body, images, **kwargs):
+        self.wait_for_rate_limit(prompt, input_body, images, max_tokens=1000)
+        body = self.build_request_body(prompt, input_body, images, **kwargs)
 
+        if self.stream:
+            with self.client.messages.stream(**body, timeout=self.stream_timeout) as stream:
+                out = self.collect_stream(stream.text_stream, stream_to=kwargs.get('stream_to'))
+                add_request_stat("input_tokens", stream.get_final_message().usage.input_tokens)
+                return out
+
+        response = self.client.messages.create(**body)
+        add_request_stat("input_tokens", response.usage.input_tokens)
+        add_request_stat("output_tokens", response.usage.output_tokens)
         out = response.content[0].text
         return out
 
+    def batch_line(self, custom_id, body):
+        return {"custom_id": custom_id, "params": body}
+
+    def submit_batch(self, batch_path):
+        """
+        :param batch_path: JSONL file of `batch_line`s
+        :return: id of the batch
+        """
+        with open(batch_path, 'r') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        return self.client.messages.batches.create(requests=requests).id
+
+    def batch_results(self, batch_id):
+        """
+        :return: None while the batch is running, then a dict custom_id -> output of the succeeded requests
+        """
+        batch = self.client.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            return None
+
+        results = {}
+        nr_failed = 0
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = entry.result.message.content[0].text
+            else:
+                nr_failed += 1
+        if nr_failed > 0:
+            print(f"Batch {batch_id}: {nr_failed} requests failed")
+        return results
+
 
+@register_client('hf_text_gen')
 class HFTextGenClient(LLMClient):
+    consumes_images = False
+
     def __init__(self, model, server_url):
         super(HFTextGenClient, self).__init__()
+        text_generation = self.import_backend()
         self.model = model
         self.server_url = server_url
         self.client = text_generation.Client(self.server_url, timeout=5000)
 
+    @staticmethod
+    def import_backend():
+        import text_generation
+        return text_generation
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(model=args.llm_name_full, server_url=args.server_url)
+
+    def cache_params(self):
+        return {"client": type(self).__name__, "model": self.model}
+
     def send_request(self, prompt, input_body, images, **kwargs):
         max_new_tokens = kwargs['max_tokens'] if 'max_tokens' in kwargs else 952
-        return self.client.generate(f"{prompt} \n{input_body}", max_new_tokens=max_new_tokens).generated_text
+        self.wait_for_rate_limit(prompt, input_body, [], max_tokens=max_new_tokens)
+        if self.stream:
+            # The timeout of the requests library applies to each read, i.e. to the time between two tokens
+            stream_client = self.import_backend().Client(self.server_url, timeout=self.stream_timeout)
+            responses = stream_client.generate_stream(f"{prompt} \n{input_body}", max_new_tokens=max_new_tokens)
+            return self.collect_stream(
+                (response.token.text for response in responses if not response.token.special),
+                stream_to=kwargs.get('stream_to')
+            )
+        response = self.client.generate(f"{prompt} \n{input_body}", max_new_tokens=max_new_tokens)
+        if response.details is not None:
+            add_request_stat("output_tokens", response.details.generated_tokens)
+        return response.generated_text
+
+
+@register_client('hf_text_gen_async')
+class HFTextGenAsyncClient(LLMClient):
+    """
+    Client of a text-generation-inference server that keeps up to `max_inflight` generate calls in flight over a
+    pooled connection, so that the continuous batching of the server is used. The requests of all threads and the
+    requests of a batch (send_batch) run concurrently on one event loop in a background thread. When max_inflight
+    calls are running, further requests wait for a free slot.
+    """
+    consumes_images = False
+
+    def __init__(self, model, server_url, max_inflight=16):
+        super(HFTextGenAsyncClient, self).__init__()
+        self.aiohttp = self.import_backend()
+        self.model = model
+        self.server_url = server_url.rstrip('/')
+        self.max_inflight = max_inflight
 
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.session, self.semaphore = self.run(self.create_session())
+        atexit.register(self.close)
 
+    @staticmethod
+    def import_backend():
+        import aiohttp
+        return aiohttp
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(model=args.llm_name_full, server_url=args.server_url, max_inflight=args.max_inflight)
+
+    def cache_params(self):
+        # Same answers as HFTextGenClient, so both share their cached responses
+        return {"client": HFTextGenClient.__name__, "model": self.model}
+
+    async def create_session(self):
+        connector = self.aiohttp.TCPConnector(limit=self.max_inflight)
+        session = self.aiohttp.ClientSession(connector=connector, timeout=self.aiohttp.ClientTimeout(total=5000))
+        return session, asyncio.Semaphore(self.max_inflight)
+
+    def run(self, coroutine):
+        """
+        Run the coroutine on the event loop of the client and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        if self.loop.is_running():
+            self.run(self.session.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def generate(self, text, max_new_tokens):
+        """
+        :return: the generated text and the number of generated tokens
+        """
+        async with self.semaphore:
+            async with self.session.post(
+                f"{self.server_url}/generate",
+                json={"inputs": text, "parameters": {"max_new_tokens": max_new_tokens, "details": True}}
+            ) as response:
+                response.raise_for_status()
+                out = await response.json()
+                return out["generated_text"], (out.get("details") or {}).get("generated_tokens", 0)
+
+    async def generate_stream(self, text, max_new_tokens, tokens):
+        """
+        Put the tokens of the server-sent events of /generate_stream to the queue `tokens`, then None
+        """
+        try:
+            async with self.semaphore:
+                async with self.session.post(
+                    f"{self.server_url}/generate_stream",
+                    json={"inputs": text, "parameters": {"max_new_tokens": max_new_tokens}},
+                    timeout=self.aiohttp.ClientTimeout(total=None, sock_read=self.stream_timeout)
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.content:
+                        line = line.decode('utf-8').strip()
+                        if not line.startswith('data:'):
+                            continue
+                        token = json.loads(line[len('data:'):])["token"]
+                        if not token["special"]:
+                            tokens.put(token["text"])
+        finally:
+            tokens.put(None)
+
+    def stream_tokens(self, text, max_new_tokens):
+        tokens = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self.generate_stream(text, max_new_tokens, tokens), self.loop)
+        while True:
+            token = tokens.get()
+            if token is None:
+                break
+            yield token
+        # Raise the error of the request, if any
+        future.result()
+
+    def send_request(self, prompt, input_body, images, **kwargs):
+        max_new_tokens = kwargs['max_tokens'] if 'max_tokens' in kwargs else 952
+        self.wait_for_rate_limit(prompt, input_body, [], max_tokens=max_new_tokens)
+        if self.stream:
+            return self.collect_stream(self.stream_tokens(f"{prompt} \n{input_body}", max_new_tokens),
+                                       stream_to=kwargs.get('stream_to'))
+        out, nr_tokens = self.run(self.generate(f"{prompt} \n{input_body}", max_new_tokens))
+        # Recorded here, the request stats are per thread and generate runs in the thread of the event loop
+        add_request_stat("output_tokens", nr_tokens)
+        return out
+
+    def send_batch(self, requests):
+        if self.stream:
+            return super(HFTextGenAsyncClient, self).send_batch(requests)
+
+        futures = []
+        for request in requests:
+            max_new_tokens = request["kwargs"].get('max_tokens', 952)
+            self.wait_for_rate_limit(request["prompt"], request["input_body"], [], max_tokens=max_new_tokens)
+            futures.append(asyncio.run_coroutine_threadsafe(
+                self.generate(f"{request['prompt']} \n{request['input_body']}", max_new_tokens), self.loop
+            ))
+        outs = []
+        for future in futures:
+            out, nr_tokens = future.result()
+            add_request_stat("output_tokens", nr_tokens)
+            outs.append(out)
+        return outs
+
+
+@register_client('hf_llava')
 class HFLlava(LLMClient):
-    def __init__(self, model, device):
+    def __init__(self, model, device, precision='fp32', torch_threads=None, max_new_tokens=None, prefix_cache_size=0,
+                 max_pixels=None):
         """
         :param model:
         :param device: 'cuda' or 'cpu'
+        :param precision: 'fp32', 'bf16', or 'int8' (dynamically quantized linear layers, cpu only)
+        :param torch_threads: number of threads of the CPU kernels. None for the torch default
+        :param max_new_tokens: bound on the generated tokens. None to generate up to 4096 tokens including the prompt
+        :param prefix_cache_size: number of prompt prefixes whose key/value cache is kept, see `prefix_past_key_values`
+        :param max_pixels: bound on the size of the canvas the figures of a question are combined on. None: no bound
         """
         super(HFLlava, self).__init__()
+        LlavaNextProcessor, LlavaNextForConditionalGeneration = self.import_backend()
+        import torch
+
+        if precision not in ['fp32', 'bf16', 'int8']:
+            raise RuntimeError(f"Invalid precision {precision}")
+        if precision == 'int8' and device != 'cpu':
+            raise RuntimeError("int8 precision is only supported on cpu")
+        if torch_threads is not None:
+            torch.set_num_threads(torch_threads)
         self.device = device
+        self.model_name = model
+        self.precision = precision
+        self.max_new_tokens = max_new_tokens
+        self.max_pixels = max_pixels
+        self.stats = {"generated_tokens": 0, "generation_seconds": 0.0, "prefix_cache_hits": 0,
+                      "prefix_cache_misses": 0}
+        self.stats_lock = threading.Lock()
+        self.prefix_cache_size = prefix_cache_size
+        self.prefix_cache = OrderedDict()  # message prefix -> (prefix input ids, key/value cache)
+        self.prefix_cache_lock = threading.Lock()
 
-        self.model = LlavaNextForConditionalGeneration.from_pretrained(model)
+        load_kwargs = {}
+        if device == 'cpu' and importlib.util.find_spec('accelerate') is not None:
+            # Loads the weights without a second, randomly initialized copy of the model in memory
+            load_kwargs["low_cpu_mem_usage"] = True
+        self.model = LlavaNextForConditionalGeneration.from_pretrained(
+            model,
+            torch_dtype=torch.bfloat16 if precision == 'bf16' else torch.float32,
+            **load_kwargs
+        )
+        if precision == 'int8':
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
         self.model.to(self.device)
+        self.model.eval()
         logging.info("Loading model completed.")
 
         logging.info("Loading processor...")
         self.processor = LlavaNextProcessor.from_pretrained(model)
+        # Batched generation (send_batch) appends the new tokens on the right, so the prompts are padded on the left
+        self.processor.tokenizer.padding_side = "left"
+        if self.processor.tokenizer.pad_token is None:
+            self.processor.tokenizer.pad_token = self.processor.tokenizer.eos_token
         logging.info("Loading processor completed.")
 
+    @staticmethod
+    def import_backend():
+        from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration
+        return LlavaNextProcessor, LlavaNextForConditionalGeneration
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(model=args.llm_name_full, device=args.device, precision=args.precision,
+                   torch_threads=args.torch_threads, max_new_tokens=args.max_new_tokens,
+                   prefix_cache_size=args.prefix_cache_size,
+                   max_pixels=args.figure_max_megapixels * 1e6 if args.figure_max_megapixels is not None else None)
+
+    def cache_params(self):
+        params = {"client": type(self).__name__, "model": self.model_name}
+        # Only when not the default, so that the cached answers of earlier runs stay valid
+        if self.precision != 'fp32':
+            params["precision"] = self.precision
+        if self.max_new_tokens is not None:
+            params["max_new_tokens"] = self.max_new_tokens
+        if self.max_pixels is not None:
+            params["max_pixels"] = self.max_pixels
+        return params
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["tokens_per_second"] = stats["generated_tokens"] / max(stats["generation_seconds"], 1e-6)
+        return stats
+
+    def generate_kwargs(self):
+        if self.max_new_tokens is not None:
+            return {"max_new_tokens": self.max_new_tokens}
+        return {"max_length": 4096}
+
+    def generate(self, inputs, **kwargs):
+        """
+        Run generate and record the number of generated tokens and the tokens per second
+        :param kwargs: further arguments of generate, e.g. past_key_values or streamer
+        :return: generated ids, including the prompt
+        """
+        import torch
+
+        start_time = time.time()
+        with torch.inference_mode():
+            generate_ids = self.model.generate(**inputs, **self.generate_kwargs(), **kwargs)
+        elapsed = time.time() - start_time
+
+        new_ids = generate_ids[:, inputs["input_ids"].shape[1]:]
+        nr_tokens = int((new_ids != self.processor.tokenizer.pad_token_id).sum())
+        with self.stats_lock:
+            self.stats["generated_tokens"] += nr_tokens
+            self.stats["generation_seconds"] += elapsed
+        add_request_stat("input_tokens", int(inputs["attention_mask"].sum()))
+        add_request_stat("output_tokens", nr_tokens)
+        stats = request_stats()
+        stats["tokens_per_second"] = nr_tokens / max(elapsed, 1e-6)
+        print(f"**** Generated {nr_tokens} tokens in {elapsed:.1f}s, {stats['tokens_per_second']:.1f} tokens/s")
+        return generate_ids
+
+    def message_prefix(self, prompt):
+        return f"USER: <image>\n{prompt} \n"
+
+    def build_message(self, prompt, input_body):
+        return f"{self.message_prefix(prompt)}{input_body}ASSISTANT:"
+
+    def prefix_past_key_values(self, prompt, input_ids):
+        """
+        The message prefix (instructions of `prompt_prefix` or `grading_prompt_prefix`) is the same for all questions.
+        Its key/value cache is computed once and kept in an LRU of prefix_cache_size prefixes, so that only the
+        question is prefilled.
+        Only used for requests without images: with pixel values, generate must encode the whole prompt
+        :return: a copy of the key/value cache of the prefix of `input_ids`, or None
+        """
+        if self.prefix_cache_size == 0:
+            return None
+        import torch
+
+        prefix = self.message_prefix(prompt)
+        with self.prefix_cache_lock:
+            entry = self.prefix_cache.get(prefix)
+            if entry is not None:
+                self.prefix_cache.move_to_end(prefix)
+        with self.stats_lock:
+            self.stats["prefix_cache_hits" if entry is not None else "prefix_cache_misses"] += 1
+
+        if entry is None:
+            prefix_ids = self.processor(text=prefix, return_tensors="pt")["input_ids"].to(self.device)
+            with torch.inference_mode():
+                entry = (prefix_ids, self.model(input_ids=prefix_ids, use_cache=True).past_key_values)
+            with self.prefix_cache_lock:
+                self.prefix_cache[prefix] = entry
+                while len(self.prefix_cache) > self.prefix_cache_size:
+                    self.prefix_cache.popitem(last=False)
+
+        # The last tokens of the prefix may be merged with the start of the question by the tokenizer,
+        # so only the tokens that match the request are reused. At least one token is left for generate to prefill
+        prefix_ids, past_key_values = entry
+        nr_tokens = min(prefix_ids.shape[1], input_ids.shape[1] - 1)
+        matches = (prefix_ids[0, :nr_tokens] == input_ids[0, :nr_tokens].to(prefix_ids.device)).tolist()
+        nr_common = matches.index(False) if False in matches else nr_tokens
+        if nr_common == 0:
+            return None
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.crop(nr_common)
+        return past_key_values
+
+    def parse_output(self, text_from_lava):
+        # "\nUSER: What's the content of the image?\nASSISTANT: The image features a stop sign on a street corner"
+        return str(text_from_lava).split('ASSISTANT:')[-1]
+
     def send_request(self, prompt, input_body, images, **kwargs):
         if len(images) > 0:
-            image = combine_images(images)
+            image = combine_images(images, max_pixels=self.max_pixels)
         else:
             image = None
 
-        message = f"{prompt} \n{input_body}"
-        message = f"USER: <image>\n{message}ASSISTANT:"
+        message = self.build_message(prompt, input_body)
 
         if image is None:
             # Only needed for llava 1.5
@@ -153,16 +735,354 @@ class HFLlava(LLMClient):
 
         inputs = inputs.to(self.device)
 
+        generate_kwargs = {}
+        if image is None:
+            past_key_values = self.prefix_past_key_values(prompt, inputs["input_ids"])
+            if past_key_values is not None:
+                generate_kwargs["past_key_values"] = past_key_values
+
+        if self.stream:
+            from transformers import TextIteratorStreamer
+
+            # generate() runs in a background thread and pushes the decoded tokens to the streamer
+            streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True,
+                                            timeout=self.stream_timeout)
+            stats = request_stats()
+            errors = []
+
+            def generate_in_thread():
+                # The stats are recorded for the request of the calling thread
+                REQUEST_STATS.stats = stats
+                try:
+                    self.generate(inputs, streamer=streamer, **generate_kwargs)
+                except Exception as e:
+                    errors.append(e)
+                    streamer.end()
+
+            thread = threading.Thread(target=generate_in_thread)
+            thread.start()
+            # The token counts and tokens per second are recorded by `generate`
+            out = self.collect_stream(streamer, stream_to=kwargs.get('stream_to'), count_tokens=False)
+            thread.join()
+            if len(errors) > 0:
+                raise errors[0]
+            return out
+
         # Generate
-        generate_ids = self.model.generate(**inputs, max_length=4096)
+        generate_ids = self.generate(inputs, **generate_kwargs)
         text_from_lava = (
             self.processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)[0]
         )
-        # "\nUSER: What's the content of the image?\nASSISTANT: The image features a stop sign on a street corner"
-        out = str(text_from_lava).split('ASSISTANT:')[-1]
+        out = self.parse_output(text_from_lava)
+
+        return out
+
+    def send_batch(self, requests):
+        """
+        Generate the answers of several requests with one padded `generate` call.
+        The processor can not mix prompts with and without images, so those are generated in two sub-batches.
+        The prefix cache is not used: the left padding shifts the positions of the prefix
+        """
+        if self.stream or len(requests) == 1:
+            return super(HFLlava, self).send_batch(requests)
+
+        outs = [None] * len(requests)
+        with_images = [i for i in range(len(requests)) if len(requests[i]["images"]) > 0]
+        without_images = [i for i in range(len(requests)) if len(requests[i]["images"]) == 0]
+        for sub_batch in [with_images, without_images]:
+            if len(sub_batch) == 0:
+                continue
+            messages = [self.build_message(requests[i]["prompt"], requests[i]["input_body"]) for i in sub_batch]
+            if sub_batch is with_images:
+                images = [combine_images(requests[i]["images"], max_pixels=self.max_pixels) for i in sub_batch]
+                inputs = self.processor(text=messages, images=images, padding=True, return_tensors="pt")
+            else:
+                inputs = self.processor(text=messages, padding=True, return_tensors="pt")
+            inputs = inputs.to(self.device)
+
+            generate_ids = self.generate(inputs)
+            texts_from_lava = self.processor.batch_decode(generate_ids, skip_special_tokens=True,
+                                                          clean_up_tokenization_spaces=False)
+            for i, text_from_lava in zip(sub_batch, texts_from_lava):
+                outs[i] = self.parse_output(text_from_lava)
+        return outs
+
+
+# Errors worth retrying: rate limits, overloaded or failing servers, timeouts and dropped connections.
+# Everything else (bad requests, authentication, content too long, ...) fails immediately
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERROR_NAMES = {
+    # openai / anthropic
+    'APITimeoutError', 'APIConnectionError', 'RateLimitError', 'InternalServerError',
+    # text_generation
+    'OverloadedError', 'RateLimitExceededError', 'ShardNotReadyError', 'ShardTimeoutError',
+    # aiohttp
+    'ClientConnectionError', 'ServerTimeoutError', 'ClientPayloadError',
+    # requests / builtins
+    'Timeout', 'ConnectionError', 'TimeoutError',
+}
+
+
+def is_retryable(error):
+    # status_code: openai, anthropic. status: aiohttp
+    status_code = getattr(error, 'status_code', getattr(error, 'status', None))
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_after(error):
+    """
+    :return: the delay in seconds requested by the server through the Retry-After header, or None
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is None:
+        # aiohttp
+        headers = getattr(error, 'headers', None)
+    if headers is None:
+        return None
+    if headers.get('retry-after-ms') is not None:
+        try:
+            return float(headers.get('retry-after-ms')) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ClientWrapper(LLMClient):
+    """
+    Base of the clients that add behaviour (retries, caching) around another LLMClient
+    """
+    def __init__(self, llm_client):
+        super(ClientWrapper, self).__init__()
+        self.llm_client = llm_client
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Expose the attributes of the wrapped client, e.g. model
+        if name == 'llm_client':
+            raise AttributeError(name)
+        return getattr(self.llm_client, name)
+
+    # Attributes that are defined on LLMClient itself, thus not forwarded by __getattr__
+    @property
+    def image_policy(self):
+        return self.llm_client.image_policy
+
+    @property
+    def stream(self):
+        return self.llm_client.stream
+
+    @property
+    def consumes_images(self):
+        return self.llm_client.consumes_images
+
+    def count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+        add_request_stat(key, n)
 
+    def get_stats(self):
+        with self.stats_lock:
+            return {**self.llm_client.get_stats(), **self.stats}
+
+    def cache_params(self):
+        return self.llm_client.cache_params()
+
+
+class RetryClient(ClientWrapper):
+    """
+    Wraps another LLMClient and retries transient failures with jittered exponential backoff
+    """
+    def __init__(self, llm_client, max_retries=5, base_delay=1.0, max_delay=60.0):
+        super(RetryClient, self).__init__(llm_client)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"retries": 0, "failed_requests": 0}
+        # Own generator so that the jitter does not change the global random state
+        self.rng = random.Random()
+
+    def send_request(self, prompt, input_body, images, **kwargs):
+        return self.with_retries(lambda: self.llm_client.send_request(prompt, input_body, images, **kwargs))
+
+    def send_batch(self, requests):
+        return self.with_retries(lambda: self.llm_client.send_batch(requests))
+
+    def with_retries(self, send):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return send()
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self.count("failed_requests")
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * self.rng.uniform(0.5, 1.0)
+                server_delay = retry_after(e)
+                if server_delay is not None:
+                    delay = max(delay, server_delay)
+                self.count("retries")
+                logging.warning(f"{type(e).__name__}: {e}. Retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+
+class CachedClient(ClientWrapper):
+    """
+    Wraps another LLMClient and answers repeated requests from a ResponseCache.
+    Modes: 'readwrite' caches new responses, 'readonly' only reads the cache,
+    'replay' only reads the cache and fails on a miss instead of sending the request
+    """
+    def __init__(self, llm_client, response_cache, mode='readwrite'):
+        super(CachedClient, self).__init__(llm_client)
+        if mode not in ['readwrite', 'readonly', 'replay']:
+            raise RuntimeError(f"Invalid cache mode {mode}")
+        self.response_cache = response_cache
+        self.mode = mode
+        self.stats = {"cache_hits": 0, "cache_misses": 0}
+
+    def request_key(self, prompt, input_body, images, **kwargs):
+        return cache_key({
+            **self.llm_client.cache_params(),
+            "prompt": prompt,
+            "input_body": input_body,
+            "images": [image_digest(image) for image in images],
+            # stream_to is only where the answer is written while it is generated
+            "kwargs": {k: v for k, v in kwargs.items() if k != 'stream_to'}
+        })
+
+    def send_request(self, prompt, input_body, images, **kwargs):
+        key = self.request_key(prompt, input_body, images, **kwargs)
+        out = self.response_cache.get(key)
+        self.count("cache_hits" if out is not None else "cache_misses")
+        if out is not None:
+            return out
+        if self.mode == 'replay':
+            raise RuntimeError(f"Request not in the response cache {self.response_cache.cache_dir} (replay mode)")
+
+        out = self.llm_client.send_request(prompt, input_body, images, **kwargs)
+        if self.mode == 'readwrite':
+            self.response_cache.put(key, out, request=self.llm_client.cache_params())
         return out
 
+    def send_batch(self, requests):
+        """
+        Answer the cached requests from the cache and send only the others, as one batch
+        """
+        keys = [
+            self.request_key(request["prompt"], request["input_body"], request["images"], **request["kwargs"])
+            for request in requests
+        ]
+        outs = [self.response_cache.get(key) for key in keys]
+        misses = [i for i in range(len(requests)) if outs[i] is None]
+        self.count("cache_hits", len(requests) - len(misses))
+        self.count("cache_misses", len(misses))
+        if len(misses) == 0:
+            return outs
+        if self.mode == 'replay':
+            raise RuntimeError(f"Request not in the response cache {self.response_cache.cache_dir} (replay mode)")
+
+        for i, out in zip(misses, self.llm_client.send_batch([requests[i] for i in misses])):
+            outs[i] = out
+            if self.mode == 'readwrite':
+                self.response_cache.put(keys[i], out, request=self.llm_client.cache_params())
+        return outs
+
+
+def add_client_arguments(parser):
+    parser.add_argument("--server-type", choices=list(CLIENT_REGISTRY))
+    parser.add_argument("--server-url", default="openai")
+    parser.add_argument("--llm-name-full", default="gpt-3.5-turbo-0125")
+    parser.add_argument("--llm-name", default='gpt35')
+    parser.add_argument("--max-inflight", default=16, type=int,
+                        help="Concurrent generate calls of hf_text_gen_async against the server")
+    parser.add_argument("--device", default='cuda', choices=['cuda', 'cpu'], help="Device of the hf_llava model")
+    parser.add_argument("--precision", default='fp32', choices=['fp32', 'bf16', 'int8'],
+                        help="Weights of the hf_llava model. int8: dynamically quantized linear layers (cpu only)")
+    parser.add_argument("--torch-threads", default=None, type=int,
+                        help="Threads used by hf_llava on cpu. Default: the torch default (number of cores)")
+    parser.add_argument("--max-new-tokens", default=None, type=int,
+                        help="Bound on the tokens generated by hf_llava per answer, e.g. 1000 on cpu. "
+                             "Default: up to 4096 tokens including the prompt")
+    parser.add_argument("--prefix-cache-size", default=0, type=int,
+                        help="Number of instruction prefixes whose key/value cache hf_llava keeps and reuses "
+                             "for the requests without images. 0 to disable")
+    parser.add_argument("--requests-per-minute", default=None, type=float,
+                        help="Limit shared by all processes on this host using the same --rate-limit-state")
+    parser.add_argument("--tokens-per-minute", default=None, type=float,
+                        help="Limit shared by all processes on this host using the same --rate-limit-state")
+    parser.add_argument("--rate-limit-state", default=None,
+                        help="File holding the rate limit state. Default: one file per --llm-name-full in the temp dir")
+    parser.add_argument("--max-retries", default=5, type=int,
+                        help="Retries of rate-limited, failed or timed out requests. 0 to disable")
+    parser.add_argument("--retry-base-delay", default=1.0, type=float,
+                        help="Delay in seconds before the first retry, doubled for every further retry")
+    parser.add_argument("--image-max-long-edge", default=None, type=int,
+                        help="Downscale images to this long edge in pixels. Default: provider specific")
+    parser.add_argument("--image-max-megapixels", default=None, type=float,
+                        help="Downscale images to this number of megapixels. Default: provider specific")
+    parser.add_argument("--image-max-short-edge", default=None, type=int,
+                        help="Downscale images to this short edge in pixels. Default: provider specific")
+    parser.add_argument("--image-format", default=None, choices=['PNG', 'JPEG', 'WEBP'],
+                        help="Encoding of the images sent to the provider. Default: PNG")
+    parser.add_argument("--image-quality", default=None, type=int, help="Quality for JPEG and WEBP. Default: 85")
+    parser.add_argument("--image-max-request-mb", default=None, type=float,
+                        help="Budget of base64-encoded image data per request. Default: provider specific")
+    parser.add_argument("--stream", action='store_true',
+                        help="Receive answers token by token and write them to a partial file while they are generated")
+    parser.add_argument("--stream-timeout", default=60.0, type=float,
+                        help="With --stream, fail (and retry) a request if no token arrives for this many seconds")
+    parser.add_argument("--cache-mode", default='off', choices=['off', 'readwrite', 'readonly', 'replay'],
+                        help="Response cache: readonly does not store new responses, replay fails on cache misses")
+    parser.add_argument("--cache-dir", default="llm_cache")
+    parser.add_argument("--cache-max-size-gb", default=5.0, type=float)
+
+
+def create_client(args):
+    """
+    :param args: parsed arguments, see `add_client_arguments`
+    :return: the LLMClient registered for args.server_type
+    """
+    if args.server_type not in CLIENT_REGISTRY:
+        raise RuntimeError(f"server_type {args.server_type} not implemented.")
+    llm_client = CLIENT_REGISTRY[args.server_type].from_args(args)
+    if args.requests_per_minute is not None or args.tokens_per_minute is not None:
+        llm_client.rate_limiter = RateLimiter(
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            state_path=args.rate_limit_state,
+            key=args.llm_name_full
+        )
+    llm_client.stream = args.stream
+    llm_client.stream_timeout = args.stream_timeout
+    if llm_client.image_policy is not None:
+        default_policy = llm_client.image_policy
+        llm_client.image_policy = ImagePolicy(
+            max_long_edge=args.image_max_long_edge or default_policy.max_long_edge,
+            max_megapixels=args.image_max_megapixels or default_policy.max_megapixels,
+            max_short_edge=args.image_max_short_edge or default_policy.max_short_edge,
+            image_format=args.image_format or default_policy.image_format,
+            quality=args.image_quality or default_policy.quality,
+            max_request_bytes=int(args.image_max_request_mb * 1024 ** 2) if args.image_max_request_mb
+            else default_policy.max_request_bytes
+        )
+    if args.max_retries > 0:
+        llm_client = RetryClient(llm_client, max_retries=args.max_retries, base_delay=args.retry_base_delay)
+    if args.cache_mode != 'off':
+        response_cache = ResponseCache(args.cache_dir, max_size_bytes=int(args.cache_max_size_gb * 1024 ** 3))
+        llm_client = CachedClient(llm_client, response_cache, mode=args.cache_mode)
+    return llm_client
+
 
 def create_blank_image():
     # Define the size of the image (width, height)
@@ -1,66 +1,163 @@
+import copy
 import json
 import os
-from utils import grading_prompt_prefix, load_json, info_from_exam_path, encode_image, process_images, \
-    LLM_LIST, extract_answer, parse_grade, dump_json, map_index_to_llm, map_llm_to_index, load_text_file, remove_key
+import shutil
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from utils import grading_prompt_prefix, load_json, info_from_exam_path, encode_image, \
+    LLM_LIST, parse_grade, dump_json, map_index_to_llm, remove_key, \
+    load_journal, append_journal, add_figure_arguments, create_prefetch_pool, FigurePrefetcher, \
+    FIGURE_CACHE
 import argparse
 import random
-from llm_clients import OpenAIClient, ClaudeClient, HFTextGenClient, HFLlava
+from llm_clients import add_client_arguments, create_client
+from telemetry import TELEMETRY, add_telemetry_arguments
+from shot_corpus import shot_corpus
+from grade_store import grade_store
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--server-type", choices=['openai', 'claude', 'hf_text_gen', 'hf_llava'])
-    parser.add_argument("--server-url", default="openai")
-    parser.add_argument("--llm-name-full", default="gpt-3.5-turbo-0125")
-    parser.add_argument("--llm-name", default='gpt35')
+    add_client_arguments(parser)
     parser.add_argument("--nr-shots", default=0, type=int)
-    parser.add_argument("--shot-type", default="same_question", type=str, choices=['same_question', 'same_exam', 'diff_exam'])
+    parser.add_argument("--shot-type", default="same_question", type=str,
+                        choices=['same_question', 'same_exam', 'diff_exam', 'nearest'],
+                        help="nearest: the human-graded answers most similar to the graded answer, from all exams")
     parser.add_argument("--with-ref", default='no', choices=['yes', 'no'], type=str)
     parser.add_argument("--exam-json-path")
+    parser.add_argument("--max-concurrency", default=1, type=int,
+                        help="Number of (candidate LLM, question) pairs graded in parallel")
+    parser.add_argument("--batch-size", default=1, type=int,
+                        help="Number of questions sent in one request batch (generated together by hf_llava)")
+    add_figure_arguments(parser)
+    add_grader_arguments(parser)
+    add_telemetry_arguments(parser)
     args = parser.parse_args()
 
-    random.seed(0)
+    TELEMETRY.log_path = args.telemetry_log
+    FIGURE_CACHE.max_memory_bytes = args.figure_cache_memory_mb * 1024 ** 2
+    llm_clients = create_graders(args)
+    prefetch_pool = create_prefetch_pool(args.prefetch_workers)
+    try:
+        grade_exam_graders(llm_clients, args.exam_json_path,
+                           nr_shots=args.nr_shots, shot_type=args.shot_type, with_ref=args.with_ref,
+                           max_concurrency=args.max_concurrency, batch_size=args.batch_size,
+                           figure_max_megapixels=args.figure_max_megapixels, prefetch_pool=prefetch_pool,
+                           prefetch_lookahead=args.prefetch_lookahead, ensemble_method=args.ensemble_method)
+    finally:
+        if prefetch_pool is not None:
+            prefetch_pool.shutdown(cancel_futures=True)
+    for grader, llm_client in llm_clients.items():
+        print(f"Client stats of {grader}: {llm_client.get_stats()}")
 
-    exam_name, lang = info_from_exam_path(args.exam_json_path)
+
+def add_grader_arguments(parser):
+    parser.add_argument("--grader", nargs='*', default=None,
+                        help="Grade with several graders at once, each given as "
+                             "SERVER_TYPE,LLM_NAME,LLM_NAME_FULL[,SERVER_URL]. The other client arguments are shared. "
+                             "Default: the single grader of --server-type, --llm-name, --llm-name-full, --server-url")
+    parser.add_argument("--ensemble-method", default='median', choices=['mean', 'median'],
+                        help="With several graders, aggregation of their points to the ensemble grade")
+
+
+def create_graders(args):
+    """
+    :return: dict grader name -> LLMClient, see `add_grader_arguments`
+    """
+    if not args.grader:
+        return {args.llm_name: create_client(args)}
+    llm_clients = {}
+    for grader in args.grader:
+        fields = grader.split(',')
+        if len(fields) not in [3, 4]:
+            raise RuntimeError(f"Invalid grader `{grader}`, expected SERVER_TYPE,LLM_NAME,LLM_NAME_FULL[,SERVER_URL]")
+        grader_args = copy.copy(args)
+        grader_args.server_type, grader_args.llm_name, grader_args.llm_name_full = fields[:3]
+        if len(fields) == 4:
+            grader_args.server_url = fields[3]
+        if grader_args.llm_name in llm_clients:
+            raise RuntimeError(f"Grader {grader_args.llm_name} given twice")
+        llm_clients[grader_args.llm_name] = create_client(grader_args)
+    return llm_clients
+
+
+def grade_exam(llm_client, exam_json_path, llm_name, nr_shots=0, shot_type="same_question", with_ref='no',
+               max_concurrency=1, batch_size=1, figure_max_megapixels=None, prefetch_pool=None, prefetch_lookahead=4):
+    grade_exam_graders({llm_name: llm_client}, exam_json_path, nr_shots=nr_shots, shot_type=shot_type,
+                       with_ref=with_ref, max_concurrency=max_concurrency, batch_size=batch_size,
+                       figure_max_megapixels=figure_max_megapixels, prefetch_pool=prefetch_pool,
+                       prefetch_lookahead=prefetch_lookahead)
+
+
+def grade_exam_graders(llm_clients, exam_json_path, nr_shots=0, shot_type="same_question", with_ref='no',
+                       max_concurrency=1, batch_size=1, figure_max_megapixels=None, prefetch_pool=None,
+                       prefetch_lookahead=4, ensemble_method='median'):
+    """
+    Grade the exam with every grader of llm_clients. The prompts and figures are prepared once and sent to all
+    graders. With several graders, the ensemble grades are written as well, see `write_ensemble_grades`
+    :param llm_clients: dict grader name -> LLMClient
+    """
+    graders = list(llm_clients.keys())
+    # All jobs are built before any request is sent, so the shots are sampled in the same order as in a sequential
+    # run, whatever the order in which the requests complete
+    jobs = list(grading_jobs(exam_json_path, graders, nr_shots=nr_shots, shot_type=shot_type, with_ref=with_ref))
+    grade_jobs(llm_clients, jobs, max_concurrency=max_concurrency, batch_size=batch_size,
+               figure_max_megapixels=figure_max_megapixels, prefetch_pool=prefetch_pool,
+               prefetch_lookahead=prefetch_lookahead)
+    if len(graders) > 1:
+        write_ensemble_grades(exam_json_path, graders, ensemble_method, nr_shots=nr_shots, shot_type=shot_type,
+                              with_ref=with_ref)
+
+
+def grade_out_dir(exam_name, grader, nr_shots=0, shot_type="same_question", with_ref='no'):
+    if with_ref == 'no':
+        out_dir = f"llm_grade/{exam_name}/grader_{grader}/{nr_shots}_shot"
+    elif with_ref == 'yes':
+        out_dir = f"llm_grade/{exam_name}/grader_{grader}/{nr_shots}_shot_with_ref"
+    else:
+        raise RuntimeError(f"Invalid value for --with-ref")
+    if nr_shots > 0:
+        out_dir = f"{out_dir}/{shot_type}_shot"
+    return out_dir
+
+
+def grading_jobs(exam_json_path, llm_name, nr_shots=0, shot_type="same_question", with_ref='no'):
+    """
+    Build the grading requests of an exam, one job per candidate LLM and grader whose grades are not available yet.
+    The jobs of the graders of a candidate LLM share the same requests
+    :param llm_name: name of the grader, or list of names of graders
+    :return: generator of dicts with the output path, the shot info and the requests ("question", "prompt",
+    "input_body", "max_score", "shot_questions", "kwargs") of every question of the exam
+    """
+    graders = [llm_name] if isinstance(llm_name, str) else llm_name
+    # Each exam has its own random generator, so that the shots do not depend on other exams graded in the same process
+    rng = random.Random(0)
+
+    exam_name, lang = info_from_exam_path(exam_json_path)
     additional_info_path = f"human_feedback/{exam_name}/additional_info.json"
     if not os.path.isfile(additional_info_path):
         print(f"Exam additional info not found at {additional_info_path}. Skip.")
-        exit()
-    additional_info = load_json(additional_info_path)
-
-    if args.server_type == 'openai':
-        llm_client = OpenAIClient(model=args.llm_name_full, server_url=args.server_url, seed=0)
-    elif args.server_type == 'claude':
-        llm_client = ClaudeClient(model=args.llm_name_full)
-    elif args.server_type == 'hf_text_gen':
-        llm_client = HFTextGenClient(model=args.llm_name_full, server_url=args.server_url)
-    elif args.server_type == 'hf_llava':
-        llm_client = HFLlava(model=args.llm_name_full, device='cuda')
-    else:
-        raise RuntimeError(f"server_type {args.server_type} not implemented.")
+        return
+    # Exams, answers and human grades are loaded once per run and shared by all candidate LLMs and exams
+    corpus = shot_corpus(lang)
+    additional_info = corpus.additional_info(exam_name)
 
-    if args.with_ref == 'no':
-        out_dir = f"llm_grade/{exam_name}/grader_{args.llm_name}/{args.nr_shots}_shot"
-    elif args.with_ref == 'yes':
-        out_dir = f"llm_grade/{exam_name}/grader_{args.llm_name}/{args.nr_shots}_shot_with_ref"
-    else:
-        raise RuntimeError(f"Invalid value for --with-ref")
-    if args.nr_shots > 0:
-        out_dir = f"{out_dir}/{args.shot_type}_shot"
-    os.makedirs(out_dir, exist_ok=True)
+    out_dirs = {grader: grade_out_dir(exam_name, grader, nr_shots, shot_type, with_ref) for grader in graders}
+    for out_dir in out_dirs.values():
+        os.makedirs(out_dir, exist_ok=True)
 
-    exam = load_json(f"exams_json/{exam_name}/{exam_name}_{lang}.json")
-    llm_out_dir = f"llm_out_filtered"
+    exam = corpus.exam(exam_name)
 
     for llm_id in range(len(LLM_LIST)):
-        if args.nr_shots == 0:
+        if nr_shots == 0 or shot_type == 'nearest':
+            # With nearest, the shots are retrieved per question below
             shot_llms, shot_exam_name = None, None
         else:
             shot_llms = [x for x in range(len(LLM_LIST[:7])) if x != llm_id] # select from the first 6 LLMs that have grading, and exclude the LLM in consideration
-            shot_llms = random.sample(shot_llms, k=args.nr_shots)
+            shot_llms = rng.sample(shot_llms, k=nr_shots)
             shot_llms = [map_index_to_llm(x) for x in shot_llms]
 
-            if args.shot_type in ['same_question', 'same_exam']:
+            if shot_type in ['same_question', 'same_exam']:
                 shot_exam_name = exam_name
             else:
                 if lang == 'en':
@@ -70,109 +167,351 @@ def main():
                 else:
                     raise RuntimeError(f"lang {lang} not valid.")
 
-        shot_exam = load_json(f"exams_json/{shot_exam_name}/{shot_exam_name}_{lang}.json") if args.nr_shots != 0 else None
-        shot_additional_info = load_json(f"human_feedback/{shot_exam_name}/additional_info.json") if args.nr_shots != 0 else None
+        shot_exam = corpus.exam(shot_exam_name) if shot_llms is not None else None
+        shot_additional_info = corpus.additional_info(shot_exam_name) if shot_llms is not None else None
         shot_llm_answers = [
-            load_text_file(f"{llm_out_dir}/{shot_exam_name}/{shot_exam_name}_{lang}_{map_llm_to_index(x)}.txt", single_str=True)
+            corpus.answers(shot_exam_name, x)
             for x in shot_llms
-        ] if args.nr_shots != 0 else None
+        ] if shot_llms is not None else None
         shot_human_grades = [
             load_human_grades(shot_exam_name, lang, shot_llm)
             for shot_llm in shot_llms
-        ] if args.nr_shots != 0 else None
-
-        grade_out_path = f"{out_dir}/{exam_name}_{lang}_{LLM_LIST[llm_id]}_grade.json"
+        ] if shot_llms is not None else None
 
-        if os.path.isfile(grade_out_path):
-            print(f"Grade already available at {grade_out_path}. Skip.")
+        grade_out_paths = {}
+        for grader, out_dir in out_dirs.items():
+            grade_out_path = f"{out_dir}/{exam_name}_{lang}_{LLM_LIST[llm_id]}_grade.json"
+            if os.path.isfile(grade_out_path):
+                print(f"Grade already available at {grade_out_path}. Skip.")
+            else:
+                grade_out_paths[grader] = grade_out_path
+        if len(grade_out_paths) == 0:
             continue
 
-        grades = []
-        total_failed = 0
-        total_points = 0
-
-        llm_out_path = f"{llm_out_dir}/{exam_name}/{exam_name}_{lang}_llm{llm_id}.txt"
-        exam_answer = load_text_file(llm_out_path, single_str=True)
+        exam_answer = corpus.answers(exam_name, LLM_LIST[llm_id])
+        if nr_shots != 0 and shot_type == 'nearest':
+            # One similarity query for all questions. The human grades of the graded answers are excluded
+            nearest_shots = corpus.nearest(
+                [(x, find_answer(x['Index'], exam_answer)) for x in exam['Questions']], k=nr_shots,
+                exclude_exam=exam_name, exclude_llm=LLM_LIST[llm_id]
+            )
 
+        requests = []
         for q in range(len(exam['Questions'])):
             question = exam['Questions'][q].copy()
             question_id = question.pop("Index")
+            nearest_info = {}
 
-            if args.nr_shots == 0:
+            if nr_shots == 0:
                 shot_questions = None
                 shots = []
+            elif shot_type == 'nearest':
+                shot_questions = [entry["question"]["Index"] for entry in nearest_shots[q]]
+                nearest_info = {"shot_llms": [entry["llm"] for entry in nearest_shots[q]],
+                                "shot_exams": [entry["exam_name"] for entry in nearest_shots[q]]}
+                shots = [
+                    build_shot(entry["question"], entry["answer"], entry["info"], entry["gold_grade"], lang, with_ref)
+                    for entry in nearest_shots[q]
+                ]
             else:
-                if args.shot_type == "same_question":
-                    shot_questions_id = [q] * args.nr_shots
-                    shot_questions = [question_id] * args.nr_shots
-                elif args.shot_type == "same_exam":
+                if shot_type == "same_question":
+                    shot_questions_id = [q] * nr_shots
+                    shot_questions = [question_id] * nr_shots
+                elif shot_type == "same_exam":
                     other_questions_id = [i for i in range(len(shot_exam['Questions'])) if i != q]
-                    shot_questions_id = random.sample(other_questions_id, k=args.nr_shots)
+                    shot_questions_id = rng.sample(other_questions_id, k=nr_shots)
                     shot_questions = [shot_exam["Questions"][i]["Index"] for i in shot_questions_id]
                 else:
                     other_questions_id = [i for i in range(len(shot_exam['Questions']))]
-                    shot_questions_id = random.sample(other_questions_id, k=args.nr_shots)
+                    shot_questions_id = rng.sample(other_questions_id, k=nr_shots)
                     shot_questions = [shot_exam["Questions"][i]["Index"] for i in shot_questions_id]
 
                 # Put all info of the shots to a list of dict.
                 # Each shot should contain the question, the llm output, and the grade
-                shots = [{
-                    "Question": json.dumps(remove_key(shot_exam['Questions'][shot_questions_id[i]], "Index")),
-                    "Answer": extract_answer(shot_exam['Questions'][shot_questions_id[i]]['Index'], shot_llm_answers[i]),
-                    "CorrectAnswer": return_gold_answer(shot_additional_info['Questions'][shot_questions_id[i]], lang) if args.with_ref == "yes" else None,
-                    "MaxScore": float(str(shot_additional_info["Questions"][shot_questions_id[i]]["MaximumPoints"]).replace(',', '.')),
-                    "GoldGrade": shot_human_grades[i]['Questions'][shot_questions_id[i]]['Points']
-                } for i in range(args.nr_shots)]
+                shots = [build_shot(
+                    shot_exam['Questions'][shot_questions_id[i]],
+                    find_answer(shot_exam['Questions'][shot_questions_id[i]]['Index'], shot_llm_answers[i]),
+                    shot_additional_info['Questions'][shot_questions_id[i]],
+                    shot_human_grades[i]['Questions'][shot_questions_id[i]]['Points'],
+                    lang, with_ref
+                ) for i in range(nr_shots)]
 
             max_score = float(str(additional_info["Questions"][q]["MaximumPoints"]).replace(',', '.'))
-            prompt = grading_prompt_prefix(lang=lang, shots=shots, with_ref=True if args.with_ref == "yes" else False)
+            prompt = grading_prompt_prefix(lang=lang, shots=shots, with_ref=True if with_ref == "yes" else False)
             question_text = json.dumps(question)
-            answer_text = extract_answer(question_id, exam_answer)
+            answer_text = find_answer(question_id, exam_answer)
             correct_answer_prompt = \
                 f"[correct_answer]\n{return_gold_answer(additional_info['Questions'][q], lang)}\n[/correct_answer] \n" \
-                if args.with_ref == "yes" else ""
+                if with_ref == "yes" else ""
             input_body = f"[question]\n{question_text}\n[/question] \n" \
                          f"[answer]\n{answer_text}\n[/answer] \n" \
                          f"{correct_answer_prompt}" \
                          f"[max_score] {max_score} [/max_score] \n"
 
-            out = llm_client.send_request(
-                prompt,
-                input_body=input_body,
-                images=process_images(exam_name, question),
-                max_tokens=500
+            requests.append({
+                "question": exam['Questions'][q],
+                "prompt": prompt,
+                "input_body": input_body,
+                "max_score": max_score,
+                "shot_questions": shot_questions,
+                **nearest_info,
+                "kwargs": {"max_tokens": 500}
+            })
+
+        for grader, grade_out_path in grade_out_paths.items():
+            yield {
+                "exam_name": exam_name,
+                "lang": lang,
+                "llm": LLM_LIST[llm_id],
+                "grader": grader,
+                "grade_out_path": grade_out_path,
+                "shot_llms": shot_llms,
+                "shot_exam_name": shot_exam_name,
+                "requests": requests
+            }
+
+
+def grade_jobs(llm_clients, jobs, max_concurrency=1, batch_size=1, figure_max_megapixels=None, prefetch_pool=None,
+               prefetch_lookahead=4):
+    """
+    Send the grading requests of the jobs built by `grading_jobs` (one exam) and write the grades to the output path
+    of each job. The pending requests of all jobs, i.e. all (candidate LLM, question) pairs, are sent by a pool of
+    max_concurrency threads, in batches of batch_size requests of the same candidate LLM. The figures of a batch are
+    rendered once and the batch is sent to all graders of the candidate LLM in parallel
+    :param llm_clients: dict grader name -> LLMClient
+    :param prefetch_pool: process pool rendering the figures ahead of the requests, see `create_prefetch_pool`
+    """
+    if len(jobs) == 0:
+        return
+
+    groups = {}  # (exam, lang, candidate LLM) -> requests and states of the jobs of the graders
+    for job in jobs:
+        # Grades are journaled per question, so that an interrupted run resumes at the first missing question
+        journal_path = job["grade_out_path"].replace('_grade.json', '_grade_journal.jsonl')
+        journal = load_journal(journal_path)
+        if len(journal) > 0:
+            print(f"Resuming from {journal_path}: {len(journal)}/{len(job['requests'])} questions already graded")
+        # With --stream, each grade is written to <partial_dir>/<question>.txt while it is generated
+        partial_dir = None
+        if llm_clients[job["grader"]].stream:
+            partial_dir = job["grade_out_path"].replace('_grade.json', '_grade_partial')
+            os.makedirs(partial_dir, exist_ok=True)
+
+        state = {"job": job, "journal_path": journal_path, "journal": journal, "partial_dir": partial_dir,
+                 "pending": {request["question"]["Index"] for request in job["requests"]
+                             if request["question"]["Index"] not in journal}}
+        group = groups.setdefault((job["exam_name"], job["lang"], job["llm"]),
+                                  {"requests": job["requests"], "states": []})
+        group["states"].append(state)
+
+    batches = []  # (group, requests pending for at least one grader)
+    for group in groups.values():
+        pending_requests = [request for request in group["requests"]
+                            if any(request["question"]["Index"] in state["pending"] for state in group["states"])]
+        for start in range(0, len(pending_requests), batch_size):
+            batches.append((group, pending_requests[start:start + batch_size]))
+    TELEMETRY.add_requests(sum(request["question"]["Index"] in state["pending"]
+                               for group, batch in batches for request in batch for state in group["states"]))
+
+    # The figures of all batches, in the order the batches are sent
+    questions = [request["question"] for _, batch in batches for request in batch]
+    offsets = [0]
+    for _, batch in batches:
+        offsets.append(offsets[-1] + len(batch))
+
+    # Graders whose image policies render the figures at the same resolution share the rendered pages
+    prefetchers = {}
+    for llm_client in llm_clients.values():
+        if render_key(llm_client) not in prefetchers:
+            prefetchers[render_key(llm_client)] = FigurePrefetcher(
+                prefetch_pool, jobs[0]["exam_name"], questions, image_policy=llm_client.image_policy,
+                max_megapixels=figure_max_megapixels, lookahead=prefetch_lookahead,
+                consumes_images=llm_client.consumes_images
             )
 
-            grade = parse_grade(out, max_score=max_score)
+    def grade_group_batch(i, grader_executor):
+        group, requests = batches[i]
+        images = {
+            key: [prefetcher.get(offsets[i] + j) for j in range(len(requests))]
+            for key, prefetcher in prefetchers.items()
+        }
+        sends = []
+        for state in group["states"]:
+            llm_client = llm_clients[state["job"]["grader"]]
+            pending = [j for j in range(len(requests)) if requests[j]["question"]["Index"] in state["pending"]]
+            if len(pending) > 0:
+                sends.append((llm_client, state, [requests[j] for j in pending],
+                              [images[render_key(llm_client)][j] for j in pending]))
+        if grader_executor is None:
+            return [(send[1], grade_batch(*send)) for send in sends]
+        return list(zip([send[1] for send in sends], grader_executor.map(lambda send: grade_batch(*send), sends)))
+
+    grader_executor = ThreadPoolExecutor(max_workers=max_concurrency * len(llm_clients)) \
+        if len(llm_clients) > 1 else None
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for batch_grades in executor.map(lambda i: grade_group_batch(i, grader_executor), range(len(batches))):
+                for state, grades in batch_grades:
+                    for grade in grades:
+                        state["journal"][grade["Index"]] = grade
+    finally:
+        if grader_executor is not None:
+            grader_executor.shutdown()
+        for prefetcher in prefetchers.values():
+            prefetcher.cancel()
+
+    for group in groups.values():
+        for state in group["states"]:
+            write_grades(state)
+
+
+def render_key(llm_client):
+    """
+    :return: the parameters of the image policy that `process_images` renders the figures with,
+        or "no_images" for clients that only send text
+    """
+    if not llm_client.consumes_images:
+        return "no_images"
+    image_policy = llm_client.image_policy
+    if image_policy is None:
+        return None
+    return image_policy.max_long_edge, image_policy.max_megapixels, image_policy.max_short_edge
+
+
+def grade_batch(llm_client, state, requests, images):
+    """
+    Send a batch of grading requests of one job and journal the grades
+    :param images: images of each request
+    :return: list of the grades
+    """
+    job, partial_dir = state["job"], state["partial_dir"]
+    stream_paths = [
+        f"{partial_dir}/{request['question']['Index']}.txt" if partial_dir is not None else None
+        for request in requests
+    ]
+    outs, records = TELEMETRY.send_batch(llm_client, [
+        {
+            "prompt": request["prompt"],
+            "input_body": request["input_body"],
+            "images": images[i],
+            "kwargs": {**request["kwargs"], "stream_to": stream_paths[i]} if partial_dir is not None
+            else request["kwargs"]
+        }
+        for i, request in enumerate(requests)
+    ], [
+        {"task": "grade", "exam": job["exam_name"], "lang": job["lang"], "llm": job["llm"],
+         "grader": job["grader"], "Index": request["question"]["Index"]}
+        for request in requests
+    ])
+
+    grades = []
+    for request, out, stream_path, record in zip(requests, outs, stream_paths, records):
+        question_id = request["question"]["Index"]
+        grades.append({
+            "Index": question_id,
+            "PromptInput": f"{request['prompt']}\n{request['input_body']}",
+            "ShotLLMs": request.get("shot_llms", job["shot_llms"]),
+            "ShotExam": request.get("shot_exams", job["shot_exam_name"]),
+            "ShotQuestion": request["shot_questions"],
+            "FullOutput": out,
+            "Points": parse_grade(out, max_score=request["max_score"])
+        })
+        append_journal(grades[-1], state["journal_path"])
+        TELEMETRY.record({**record, "parse_success": grades[-1]["Points"] is not None})
+        if stream_path is not None and os.path.isfile(stream_path):
+            os.remove(stream_path)
+    return grades
+
+
+def write_grades(state):
+    """
+    Write the grades of all questions of the job, in exam order, and remove its journal
+    """
+    job = state["job"]
+    grades = [state["journal"][request["question"]["Index"]] for request in job["requests"]]
+    total_failed = sum(grade["Points"] is None for grade in grades)
+    total_points = sum(grade["Points"] for grade in grades if grade["Points"] is not None)
+
+    grade_file = {
+        "Questions": grades,
+        "TotalPoints": total_points,
+        "NrFailed": total_failed,
+        "TotalGradeGermanScale": None
+    }
+    dump_json(grade_file, file_path=job["grade_out_path"])
+    grade_store().put_grade_file(job["grade_out_path"], grade_file)
+    if os.path.isfile(state["journal_path"]):
+        os.remove(state["journal_path"])
+    if state["partial_dir"] is not None:
+        shutil.rmtree(state["partial_dir"], ignore_errors=True)
+
+
+def write_ensemble_grades(exam_json_path, graders, ensemble_method, nr_shots=0, shot_type="same_question",
+                          with_ref='no'):
+    """
+    Aggregate the points of the graders per question (mean or median of the parsed grades) and write them, in the
+    layout of the grade files, to the grader directory ensemble_<method>_<grader>+<grader>+...
+    Candidate LLMs that are not graded by all graders yet are skipped
+    """
+    exam_name, lang = info_from_exam_path(exam_json_path)
+    ensemble_name = f"ensemble_{ensemble_method}_{'+'.join(graders)}"
+    out_dir = grade_out_dir(exam_name, ensemble_name, nr_shots, shot_type, with_ref)
+    aggregate = statistics.mean if ensemble_method == 'mean' else statistics.median
+
+    for llm in LLM_LIST:
+        grade_paths = [
+            f"{grade_out_dir(exam_name, grader, nr_shots, shot_type, with_ref)}/{exam_name}_{lang}_{llm}_grade.json"
+            for grader in graders
+        ]
+        if not all(os.path.isfile(path) for path in grade_paths):
+            continue
+        grader_points = [{q["Index"]: q["Points"] for q in load_json(path)["Questions"]} for path in grade_paths]
+
+        grades = []
+        for question_id in grader_points[0]:
+            points = {grader: grader_points[i].get(question_id) for i, grader in enumerate(graders)}
+            valid_points = [x for x in points.values() if x is not None]
             grades.append({
                 "Index": question_id,
-                "PromptInput": f"{prompt}\n{input_body}",
-                "ShotLLMs": shot_llms,
-                "ShotExam": shot_exam_name,
-                "ShotQuestion": shot_questions,
-                "FullOutput": out,
-                "Points": grade
+                "GraderPoints": points,
+                "Points": aggregate(valid_points) if len(valid_points) > 0 else None
             })
-            if grade is not None:
-                total_points = total_points + grade
-            else:
-                total_failed = total_failed + 1
+        os.makedirs(out_dir, exist_ok=True)
+        grade_file = {
+            "Questions": grades,
+            "TotalPoints": sum(grade["Points"] for grade in grades if grade["Points"] is not None),
+            "NrFailed": sum(grade["Points"] is None for grade in grades),
+            "TotalGradeGermanScale": None,
+            "Graders": graders,
+            "EnsembleMethod": ensemble_method
+        }
+        dump_json(grade_file, file_path=f"{out_dir}/{exam_name}_{lang}_{llm}_grade.json")
+        grade_store().put_grade_file(f"{out_dir}/{exam_name}_{lang}_{llm}_grade.json", grade_file)
+
+
+def build_shot(question, answer, info, gold_grade, lang, with_ref):
+    """
+    Put all info of a shot to a dict: the question, the llm output, and the grade
+    :param info: additional info of the question
+    """
+    return {
+        "Question": json.dumps(remove_key(question, "Index")),
+        "Answer": answer,
+        "CorrectAnswer": return_gold_answer(info, lang) if with_ref == "yes" else None,
+        "MaxScore": float(str(info["MaximumPoints"]).replace(',', '.')),
+        "GoldGrade": gold_grade
+    }
+
 
-        dump_json(
-            {
-                "Questions": grades,
-                "TotalPoints": total_points,
-                "NrFailed": total_failed,
-                "TotalGradeGermanScale": None
-            },
-            file_path=grade_out_path
-        )
+def find_answer(question_id, answers):
+    if question_id not in answers:
+        raise RuntimeError(f"Problem with extracting answer for question {question_id}")
+    return answers[question_id]
 
 
 def load_human_grades(exam_name, lang, llm):
-    path = f"human_feedback/{exam_name}/grades/{exam_name}_{lang}_{map_llm_to_index(llm)}_grade.json"
-    if os.path.isfile(path):
-        data = load_json(path)
+    data = shot_corpus(lang).human_grades(exam_name, llm)
+    if data is not None:
         for q in data['Questions']:
             if q['Points'] is None:
                 print(f"Human grade not filled at {exam_name}, {lang}, {llm}")
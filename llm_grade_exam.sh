@@ -35,19 +35,12 @@ if [ -z ${SHOT_TYPE} ]; then
   SHOT_TYPE="same_question"
 fi
 
-# Loop through each JSON file in the current directory and its subdirectories
-for file in $(find exams_json/ -type f -name '*.json'); do
-  echo "Processing exam at $file"
-  echo "Sending grading request ..."
-  python -u llm_grade_exam.py \
-    --server-type ${SERVER_TYPE} \
-    --server-url ${SERVER_URL} \
-    --llm-name-full ${LLM_NAME_FULL} \
-    --llm-name ${LLM_NAME} \
-    --exam-json-path ${file} \
-    --nr-shots ${NR_SHOT} \
-    --shot-type ${SHOT_TYPE} \
-    --with-ref ${REF}
-
-  echo "---------------------------------------------------------"
-done
+# Grade every JSON exam under exams_json/ in a single Python process
+python -u sciex.py run grade \
+  --server-type ${SERVER_TYPE} \
+  --server-url ${SERVER_URL} \
+  --llm-name-full ${LLM_NAME_FULL} \
+  --llm-name ${LLM_NAME} \
+  --nr-shots ${NR_SHOT} \
+  --shot-type ${SHOT_TYPE} \
+  --with-ref ${REF}
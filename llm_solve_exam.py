@@ -1,62 +1,164 @@
 import json
 import os
-from utils import prompt_prefix, load_json, write_text_file, info_from_exam_path, process_images
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from utils import prompt_prefix, load_json, write_text_file, info_from_exam_path, load_journal, append_journal, \
+    add_figure_arguments, create_prefetch_pool, FigurePrefetcher, remove_key, FIGURE_CACHE
 import argparse
-from llm_clients import OpenAIClient, ClaudeClient, HFTextGenClient, HFLlava
+from llm_clients import add_client_arguments, create_client
+from telemetry import TELEMETRY, add_telemetry_arguments
+from answer_store import answer_store, format_answer_file
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--server-type", choices=['openai', 'claude', 'hf_text_gen', 'hf_llava'])
-    parser.add_argument("--server-url", default="openai")
-    parser.add_argument("--llm-name-full", default="gpt-3.5-turbo-0125")
-    parser.add_argument("--llm-name", default='gpt35')
+    add_client_arguments(parser)
     parser.add_argument("--exam-json-path")
+    parser.add_argument("--max-concurrency", default=1, type=int,
+                        help="Number of questions sent to the LLM in parallel")
+    parser.add_argument("--batch-size", default=1, type=int,
+                        help="Number of questions sent in one request batch (generated together by hf_llava)")
+    add_figure_arguments(parser)
+    add_telemetry_arguments(parser)
     args = parser.parse_args()
 
-    if args.server_type == 'openai':
-        llm_client = OpenAIClient(model=args.llm_name_full, server_url=args.server_url, seed=0)
-    elif args.server_type == 'claude':
-        llm_client = ClaudeClient(model=args.llm_name_full)
-    elif args.server_type == 'hf_text_gen':
-        llm_client = HFTextGenClient(model=args.llm_name_full, server_url=args.server_url)
-    elif args.server_type == 'hf_llava':
-        llm_client = HFLlava(model=args.llm_name_full, device='cuda')
-    else:
-        raise RuntimeError(f"server_type {args.server_type} not implemented.")
-
-    exam_name, lang = info_from_exam_path(args.exam_json_path)
-    out_dir = f"llm_out/{exam_name}"
-    out_path = f"{out_dir}/{exam_name}_{lang}_{args.llm_name}.txt"
+    TELEMETRY.log_path = args.telemetry_log
+    FIGURE_CACHE.max_memory_bytes = args.figure_cache_memory_mb * 1024 ** 2
+    llm_client = create_client(args)
+    prefetch_pool = create_prefetch_pool(args.prefetch_workers)
+    try:
+        solve_exam(llm_client, args.exam_json_path, args.llm_name, max_concurrency=args.max_concurrency,
+                   batch_size=args.batch_size, figure_max_megapixels=args.figure_max_megapixels,
+                   prefetch_pool=prefetch_pool, prefetch_lookahead=args.prefetch_lookahead)
+    finally:
+        if prefetch_pool is not None:
+            prefetch_pool.shutdown(cancel_futures=True)
+    print(f"Client stats: {llm_client.get_stats()}")
+
+
+def solve_exam(llm_client, exam_json_path, llm_name, max_concurrency=1, batch_size=1, figure_max_megapixels=None,
+               prefetch_pool=None, prefetch_lookahead=4):
+    """
+    :param prefetch_pool: process pool rendering the figures ahead of the requests, see `create_prefetch_pool`.
+    None: the figures are rendered when requested
+    """
+    exam_name, lang = info_from_exam_path(exam_json_path)
+    out_dir, out_path, journal_path = output_paths(exam_json_path, llm_name)
 
     if os.path.isfile(out_path):
         print("LLM output already available. Skip")
-        exit()
+        return
 
     os.makedirs(out_dir, exist_ok=True)
 
     prompt = prompt_prefix(lang)
     exam = load_json(f"exams_json/{exam_name}/{exam_name}_{lang}.json")
 
-    exam_out = ''
-    for question in exam['Questions']:
+    # Answers are journaled per question, so that an interrupted run resumes at the first missing question
+    journal = load_journal(journal_path)
+    if len(journal) > 0:
+        print(f"Resuming from {journal_path}: {len(journal)}/{len(exam['Questions'])} questions already answered")
+    pending_questions = [question for question in exam['Questions'] if question['Index'] not in journal]
+    TELEMETRY.add_requests(len(pending_questions))
+    context = {"task": "solve", "exam": exam_name, "lang": lang, "llm": llm_name}
+
+    # With --stream, each answer is written to <partial_dir>/<question>.txt while it is generated
+    partial_dir = None
+    if llm_client.stream:
+        partial_dir = f"{out_dir}/{exam_name}_{lang}_{llm_name}_partial"
+        os.makedirs(partial_dir, exist_ok=True)
+
+    prefetcher = FigurePrefetcher(prefetch_pool, exam_name, pending_questions, image_policy=llm_client.image_policy,
+                                  max_megapixels=figure_max_megapixels, lookahead=prefetch_lookahead,
+                                  consumes_images=llm_client.consumes_images)
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            batches = executor.map(
+                lambda start: solve_questions(
+                    llm_client, prompt, pending_questions[start:start + batch_size],
+                    [prefetcher.get(i) for i in range(start, min(start + batch_size, len(pending_questions)))],
+                    journal_path, context, partial_dir=partial_dir
+                ),
+                range(0, len(pending_questions), batch_size)
+            )
+            for answers in batches:
+                for question_id, out in answers:
+                    journal[question_id] = {"Index": question_id, "Answer": out}
+    finally:
+        prefetcher.cancel()
+
+    answers = {question['Index']: journal[question['Index']]['Answer'] for question in exam['Questions']}
+    write_text_file(format_answer_file([question['Index'] for question in exam['Questions']], answers), out_path)
+    answer_store("llm_out").put_answers(exam_name, lang, llm_name, answers, source_path=out_path)
+    if os.path.isfile(journal_path):
+        os.remove(journal_path)
+    if partial_dir is not None:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+
+
+def output_paths(exam_json_path, llm_name):
+    """
+    :return: output directory, answer file and journal of the exam
+    """
+    exam_name, lang = info_from_exam_path(exam_json_path)
+    out_dir = f"llm_out/{exam_name}"
+    return out_dir, f"{out_dir}/{exam_name}_{lang}_{llm_name}.txt", f"{out_dir}/{exam_name}_{lang}_{llm_name}_journal.jsonl"
+
+
+def solve_requests(exam_json_path, llm_name):
+    """
+    :return: the requests ("question", "prompt", "input_body", "kwargs") that `solve_exam` would send for the exam,
+    i.e. of the questions that are not answered yet
+    """
+    exam_name, lang = info_from_exam_path(exam_json_path)
+    out_dir, out_path, journal_path = output_paths(exam_json_path, llm_name)
+    if os.path.isfile(out_path):
+        return []
+
+    prompt = prompt_prefix(lang)
+    exam = load_json(f"exams_json/{exam_name}/{exam_name}_{lang}.json")
+    journal = load_journal(journal_path)
+    return [
+        {"question": question, "prompt": prompt, "input_body": json.dumps(remove_key(question, "Index")), "kwargs": {}}
+        for question in exam['Questions'] if question['Index'] not in journal
+    ]
+
+
+def solve_questions(llm_client, prompt, questions, images, journal_path, context, partial_dir=None):
+    """
+    Send the questions as one batch of requests
+    :param images: images of each question
+    :param context: exam, lang and llm, for the telemetry records
+    :return: list of (question_id, answer)
+    """
+    requests = []
+    for question, question_images in zip(questions, images):
+        question = question.copy()
         question_id = question.pop("Index")
         print(question)
 
-        out = llm_client.send_request(
-            prompt,
-            input_body=json.dumps(question),
-            images=process_images(exam_name, question)
-        )
+        stream_kwargs = {}
+        if partial_dir is not None:
+            stream_kwargs["stream_to"] = f"{partial_dir}/{question_id}.txt"
+        requests.append({
+            "prompt": prompt,
+            "input_body": json.dumps(question),
+            "images": question_images,
+            "kwargs": stream_kwargs
+        })
 
-        print(f'**** Answer: {out}')
-        exam_out += f"Answer to Question {question_id}\n"
-        exam_out += f"{out}\n"
-        exam_out += \
-            "\n\n\n\n\n****************************************************************************************\n"
-        exam_out += "****************************************************************************************\n\n\n\n\n"
+    outs, records = TELEMETRY.send_batch(llm_client, requests,
+                                         [{**context, "Index": question["Index"]} for question in questions])
 
-    write_text_file(exam_out, out_path)
+    answers = []
+    for question, request, out, record in zip(questions, requests, outs, records):
+        print(f'**** Answer: {out}')
+        TELEMETRY.record(record)
+        append_journal({"Index": question["Index"], "Answer": out}, journal_path)
+        if partial_dir is not None and os.path.isfile(request["kwargs"]["stream_to"]):
+            os.remove(request["kwargs"]["stream_to"])
+        answers.append((question["Index"], out))
+    return answers
 
 
 if __name__ == "__main__":
@@ -26,20 +26,9 @@ if [ -z ${SERVER_URL} ]; then
   SERVER_URL="http://i13hpc65:8080"  # Local mixtral lamma.cpp
 fi
 
-# Loop through each JSON file in the current directory and its subdirectories
-for file in $(find exams_json/ -type f -name '*.json'); do
-  echo "Processing exam at $file"
-  echo "Format checking ... "
-  python -u validate_exam_json.py \
-    --json_path ${file}
-
-  echo "Sending request ..."
-  python -u llm_solve_exam.py \
-    --server-type ${SERVER_TYPE} \
-    --server-url ${SERVER_URL} \
-    --llm-name-full ${LLM_NAME_FULL} \
-    --llm-name ${LLM_NAME} \
-    --exam-json-path ${file}
-
-  echo "---------------------------------------------------------"
-done
+# Validate and solve every JSON exam under exams_json/ in a single Python process
+python -u sciex.py run solve \
+  --server-type ${SERVER_TYPE} \
+  --server-url ${SERVER_URL} \
+  --llm-name-full ${LLM_NAME_FULL} \
+  --llm-name ${LLM_NAME}
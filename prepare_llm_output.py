@@ -1,8 +1,8 @@
 import argparse
 import os
-import shutil
 
-from utils import map_llm_to_index, LLM_LIST
+from utils import map_llm_to_index, LLM_LIST, load_json, write_text_file
+from answer_store import answer_store, format_answer_file
 
 
 def main():
@@ -11,18 +11,30 @@ def main():
 
     args = parser.parse_args()
 
-    exam_name = args.json_path.split('/')[-2]
-    exam_name_lang = args.json_path.split('/')[-1].replace('.json', '')
+    prepare_llm_output(args.json_path)
+
+
+def prepare_llm_output(json_path):
+    exam_name = json_path.split('/')[-2]
+    exam_name_lang = json_path.split('/')[-1].replace('.json', '')
+    lang = exam_name_lang.split('_')[-1]
     out_dir = f"llm_out_filtered/{exam_name}"
     os.makedirs(out_dir, exist_ok=True)
+    question_ids = [question['Index'] for question in load_json(json_path)['Questions']]
 
     for llm in LLM_LIST:
         original_output_file = f"llm_out/{exam_name}/{exam_name_lang}_{llm}.txt"
         filtered_output_file = f"llm_out_filtered/{exam_name}/{exam_name_lang}_{map_llm_to_index(llm)}.txt"
 
-        if not os.path.isfile(original_output_file):
+        answers = answer_store("llm_out").load_answers(exam_name, lang, llm, answer_file=original_output_file)
+        if len(answers) == 0:
             raise RuntimeError(f"Missing LLM output file {original_output_file}")
-        shutil.copyfile(original_output_file, filtered_output_file)
+        # In exam order, as the solving writes them
+        answer_ids = [question_id for question_id in question_ids if question_id in answers] + \
+                     [question_id for question_id in answers if question_id not in question_ids]
+
+        write_text_file(format_answer_file(answer_ids, answers), filtered_output_file)
+        answer_store("llm_out_filtered").put_answers(exam_name, lang, llm, answers, source_path=filtered_output_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+# Rough estimates used to charge a request against the tokens-per-minute budget before it is sent
+CHARS_PER_TOKEN = 4
+TOKENS_PER_IMAGE = 1000
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the requests and the tokens sent per minute.
+    The bucket state is kept in a small JSON file guarded by flock, so the limit is shared by all threads and all
+    processes on the host that use the same state file (e.g. several grading runs against the same model).
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, state_path=None, key="default"):
+        """
+        :param requests_per_minute: None for no limit on the number of requests
+        :param tokens_per_minute: None for no limit on the number of tokens
+        :param state_path: file holding the bucket state. Default: one file per `key` in the temp directory
+        :param key: name of the quota, e.g. the model name. Only used to derive the default state_path
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        if state_path is None:
+            state_path = os.path.join(tempfile.gettempdir(), f"sciex_rate_limit_{re.sub(r'[^A-Za-z0-9_.-]', '_', key)}.json")
+        self.state_path = state_path
+        self.lock = threading.Lock()
+
+    def acquire(self, nr_tokens=0):
+        """
+        Block until one request with `nr_tokens` tokens fits into the per-minute budget, then consume it
+        """
+        if self.tokens_per_minute is not None:
+            # A request larger than the whole budget would never fit
+            nr_tokens = min(nr_tokens, self.tokens_per_minute)
+        while True:
+            wait_time = self.try_acquire(nr_tokens)
+            if wait_time <= 0:
+                return
+            time.sleep(wait_time)
+
+    def try_acquire(self, nr_tokens):
+        """
+        :return: 0 if the request was admitted, otherwise the time in seconds until it would fit
+        """
+        with self.lock, open(self.state_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                state = json.loads(content) if content else {}
+                now = time.time()
+                elapsed = now - state.get("time", now)
+                requests = refill(state.get("requests"), self.requests_per_minute, elapsed)
+                tokens = refill(state.get("tokens"), self.tokens_per_minute, elapsed)
+
+                wait_time = max(
+                    time_until_available(requests, 1, self.requests_per_minute),
+                    time_until_available(tokens, nr_tokens, self.tokens_per_minute)
+                )
+                if wait_time <= 0:
+                    if requests is not None:
+                        requests = requests - 1
+                    if tokens is not None:
+                        tokens = tokens - nr_tokens
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({"time": now, "requests": requests, "tokens": tokens}))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait_time
+
+
+def refill(available, per_minute, elapsed):
+    if per_minute is None:
+        return None
+    if available is None:
+        # New bucket, start full
+        return float(per_minute)
+    return min(float(per_minute), available + elapsed * per_minute / 60)
+
+
+def time_until_available(available, needed, per_minute):
+    if per_minute is None or available >= needed:
+        return 0
+    return (needed - available) * 60 / per_minute
+
+
+def estimate_tokens(prompt, input_body, images, max_tokens):
+    """
+    :return: estimated number of tokens the request counts against the tokens-per-minute quota
+    """
+    return (len(prompt) + len(input_body)) // CHARS_PER_TOKEN + TOKENS_PER_IMAGE * len(images) + max_tokens
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of LLM responses. Each entry is a small JSON file at
+    <cache_dir>/<key[:2]>/<key>.json. The total size is bounded; the least recently used entries are evicted first
+    (recency is tracked through the file modification time, so it survives restarts and is shared between processes).
+    """
+    def __init__(self, cache_dir="llm_cache", max_size_bytes=5 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # key -> file size, ordered from least to most recently used
+        entries = []
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len('.json')], stat.st_size))
+        self.index = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_size = sum(self.index.values())
+
+    def path(self, key):
+        return f"{self.cache_dir}/{key[:2]}/{key}.json"
+
+    def get(self, key):
+        """
+        :return: the cached output, or None if the key is not cached
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        with self.lock:
+            if key in self.index:
+                self.index.move_to_end(key)
+        return entry["Output"]
+
+    def put(self, key, output, request=None):
+        """
+        :param request: small description of the request stored alongside the output, for inspection only
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        content = json.dumps({"Request": request, "Output": output})
+        # Write to a temporary file first, so that readers in other threads/processes never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_size -= self.index.pop(key, 0)
+            self.index[key] = len(content.encode('utf-8'))
+            self.total_size += self.index[key]
+            while self.total_size > self.max_size_bytes and len(self.index) > 1:
+                evicted_key, evicted_size = self.index.popitem(last=False)
+                self.total_size -= evicted_size
+                try:
+                    os.remove(self.path(evicted_key))
+                except FileNotFoundError:
+                    # Already evicted by another process
+                    pass
+
+
+def cache_key(params):
+    """
+    :param params: JSON-serializable dict describing the request
+    :return: hex digest identifying the request
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
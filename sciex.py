@@ -0,0 +1,171 @@
+import argparse
+import os
+import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from utils import list_exam_json_paths, add_figure_arguments, create_prefetch_pool, FIGURE_CACHE
+from llm_clients import add_client_arguments, create_client
+from llm_solve_exam import solve_exam
+from llm_grade_exam import grade_exam_graders, add_grader_arguments, create_graders
+from validate_exam_json import validate_exam
+from create_info_template import create_info_template
+from create_grading_template import create_grading_template
+from prepare_llm_output import prepare_llm_output
+from batch import collect_requests, run_batch
+from telemetry import TELEMETRY, add_telemetry_arguments
+
+
+def main():
+    """
+    Single-process replacement for the loops in llm_solve_exam.sh, llm_grade_exam.sh and
+    prepare_output_for_sending.sh. The LLM client (and for hf_llava the model) is created once and reused for all exams.
+    Usage: python sciex.py run solve|grade|package [options]
+           python sciex.py batch solve|grade [options]
+    The batch command sends all requests of the run through the batch API of the provider (openai, claude),
+    stores the results in the response cache, and then writes the usual outputs from the cache.
+    """
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("task", choices=['solve', 'grade', 'package'])
+    add_run_arguments(run_parser)
+    batch_parser = subparsers.add_parser("batch")
+    batch_parser.add_argument("task", choices=['solve', 'grade'])
+    add_run_arguments(batch_parser)
+    batch_parser.add_argument("--batch-dir", default="batches",
+                              help="Directory of the batch files and of the state of the submitted batches")
+    batch_parser.add_argument("--batch-poll-interval", default=60.0, type=float,
+                              help="Seconds between two status checks of the submitted batches")
+    args = parser.parse_args()
+
+    if args.exam_json_path:
+        exam_json_paths = args.exam_json_path
+    else:
+        exam_json_paths = list_exam_json_paths(from_exam_list=args.from_exam_list)
+
+    if args.task == 'package':
+        package(exam_json_paths)
+        return
+
+    if args.command == 'batch' and args.cache_mode == 'off':
+        # The batch results are handed to the solve/grade code through the response cache
+        args.cache_mode = 'readwrite'
+    if args.command == 'batch' and args.grader:
+        raise RuntimeError("--grader is not supported by the batch command, run it once per grader")
+    TELEMETRY.log_path = args.telemetry_log
+    FIGURE_CACHE.max_memory_bytes = args.figure_cache_memory_mb * 1024 ** 2
+    if args.task == 'grade':
+        llm_clients = create_graders(args)
+        llm_client = next(iter(llm_clients.values()))
+    else:
+        llm_client = create_client(args)
+        llm_clients = {args.llm_name: llm_client}
+
+    if args.task == 'solve':
+        def run_exam(exam_json_path):
+            print("Format checking ... ")
+            validate_exam(exam_json_path)
+            print("Sending request ...")
+            solve_exam(llm_client, exam_json_path, args.llm_name, max_concurrency=args.max_concurrency,
+                       batch_size=args.batch_size, figure_max_megapixels=args.figure_max_megapixels,
+                       prefetch_pool=prefetch_pool, prefetch_lookahead=args.prefetch_lookahead)
+    elif args.task == 'grade':
+        def run_exam(exam_json_path):
+            print("Sending grading request ...")
+            grade_exam_graders(llm_clients, exam_json_path,
+                               nr_shots=args.nr_shots, shot_type=args.shot_type, with_ref=args.with_ref,
+                               max_concurrency=args.max_concurrency, batch_size=args.batch_size,
+                               figure_max_megapixels=args.figure_max_megapixels, prefetch_pool=prefetch_pool,
+                               prefetch_lookahead=args.prefetch_lookahead, ensemble_method=args.ensemble_method)
+    else:
+        raise RuntimeError(f"Task {args.task} not implemented.")
+
+    if args.command == 'batch':
+        if args.task == 'grade':
+            name = f"grade_{args.llm_name}_{args.nr_shots}_shot_{args.shot_type}_ref_{args.with_ref}"
+        else:
+            name = f"solve_{args.llm_name}"
+        incomplete_exam_json_paths = run_batch(
+            llm_client,
+            lambda: collect_requests(args.task, exam_json_paths, args.llm_name, nr_shots=args.nr_shots,
+                                     shot_type=args.shot_type, with_ref=args.with_ref),
+            args.batch_dir, name, figure_max_megapixels=args.figure_max_megapixels,
+            poll_interval=args.batch_poll_interval
+        )
+        for exam_json_path in sorted(incomplete_exam_json_paths):
+            print(f"Requests of {exam_json_path} failed in the batch. Run the batch command again to resend them")
+        exam_json_paths = [path for path in exam_json_paths if path not in incomplete_exam_json_paths]
+        # Write the outputs from the cache only, nothing is sent outside of the batches
+        llm_client.mode = 'replay'
+
+    # One figure rendering pool for all exams, spawned once
+    prefetch_pool = create_prefetch_pool(args.prefetch_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=args.max_exam_concurrency) as executor:
+            # list() to re-raise errors from the worker threads
+            list(executor.map(lambda path: run_skippable(run_exam, path), exam_json_paths))
+    finally:
+        if prefetch_pool is not None:
+            prefetch_pool.shutdown(cancel_futures=True)
+    for name, client in llm_clients.items():
+        print(f"Client stats of {name}: {client.get_stats()}")
+
+
+def add_run_arguments(parser):
+    add_client_arguments(parser)
+    parser.add_argument("--exam-json-path", nargs='*', default=None,
+                        help="Exams to process. Default: every JSON file under exams_json/")
+    parser.add_argument("--from-exam-list", action='store_true',
+                        help="Take the exams from utils.EXAM_LIST instead of every JSON file under exams_json/")
+    parser.add_argument("--max-exam-concurrency", default=1, type=int,
+                        help="Number of exams processed in parallel")
+    parser.add_argument("--max-concurrency", default=1, type=int,
+                        help="Number of questions of an exam (for grade: of (candidate LLM, question) pairs) "
+                             "sent to the LLM in parallel")
+    parser.add_argument("--batch-size", default=1, type=int,
+                        help="Number of questions sent in one request batch (generated together by hf_llava)")
+    add_figure_arguments(parser)
+    parser.add_argument("--nr-shots", default=0, type=int)
+    parser.add_argument("--shot-type", default="same_question", type=str,
+                        choices=['same_question', 'same_exam', 'diff_exam', 'nearest'],
+                        help="nearest: the human-graded answers most similar to the graded answer, from all exams")
+    parser.add_argument("--with-ref", default='no', choices=['yes', 'no'], type=str)
+    add_grader_arguments(parser)
+    add_telemetry_arguments(parser)
+
+
+def run_skippable(run_exam, exam_json_path):
+    print(f"Processing exam at {exam_json_path}")
+    try:
+        run_exam(exam_json_path)
+    except SystemExit:
+        # Some helpers (e.g. missing human grades) exit() to skip the exam, which ended the
+        # per-exam process in the shell loops. Here it only skips the current exam
+        print(f"Skipped exam at {exam_json_path}")
+    print("---------------------------------------------------------")
+
+
+def package(exam_json_paths):
+    shutil.rmtree("human_feedback_template", ignore_errors=True)
+    for exam_json_path in exam_json_paths:
+        create_info_template(exam_json_path)
+        create_grading_template(exam_json_path)
+        prepare_llm_output(exam_json_path)
+
+    compress_subdirectories("llm_out_filtered", "llm_out")
+    compress_subdirectories("human_feedback_template", "templates")
+
+
+def compress_subdirectories(parent_directory, suffix):
+    """
+    Compress each subdirectory <name> of parent_directory to parent_directory/<name>_<suffix>.tar.gz
+    """
+    for subdirectory_name in sorted(os.listdir(parent_directory)):
+        if not os.path.isdir(f"{parent_directory}/{subdirectory_name}"):
+            continue
+        with tarfile.open(f"{parent_directory}/{subdirectory_name}_{suffix}.tar.gz", "w:gz") as tar:
+            tar.add(f"{parent_directory}/{subdirectory_name}", arcname=subdirectory_name)
+
+
+if __name__ == "__main__":
+    main()
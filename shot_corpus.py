@@ -0,0 +1,186 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from glob import glob
+from utils import load_json, map_llm_to_index, remove_key, LLM_LIST
+from answer_store import answer_store, marker_answer_text
+
+
+# LLMs whose answers are graded by humans and can serve as shots
+SHOT_LLM_LIST = LLM_LIST[:7]
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+class ShotCorpus:
+    """
+    Exams, additional info, answers and human grades of one language, each loaded once and shared by all grading jobs
+    of the run. For --shot-type nearest, every human-graded answer of human_feedback/ is a shot candidate, retrieved
+    by the TF-IDF cosine similarity of its question and answer to the question and answer being graded.
+    """
+    def __init__(self, lang, max_features=4096):
+        """
+        :param max_features: size of the TF-IDF vocabulary, the terms in the most documents
+        """
+        self.lang = lang
+        self.max_features = max_features
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        self.files = {}
+        self.entries = None
+        self.vocabulary = None
+        self.idf = None
+        self.matrix = None
+        self.entry_exams = None
+        self.entry_llms = None
+
+    def load(self, key, load_fn):
+        with self.lock:
+            if key not in self.files:
+                self.files[key] = load_fn()
+            return self.files[key]
+
+    def exam(self, exam_name):
+        return self.load(("exam", exam_name),
+                         lambda: load_json(f"exams_json/{exam_name}/{exam_name}_{self.lang}.json"))
+
+    def additional_info(self, exam_name):
+        return self.load(("additional_info", exam_name),
+                         lambda: load_json(f"human_feedback/{exam_name}/additional_info.json"))
+
+    def answers(self, exam_name, llm):
+        """
+        :return: dict question Index -> answer of the LLM in llm_out_filtered, as inserted into the grading prompts
+        """
+        def load_answers():
+            answer_file = f"llm_out_filtered/{exam_name}/{exam_name}_{self.lang}_{map_llm_to_index(llm)}.txt"
+            answers = answer_store("llm_out_filtered").load_answers(exam_name, self.lang, llm, answer_file=answer_file)
+            return {question_id: marker_answer_text(answer) for question_id, answer in answers.items()}
+        return self.load(("answers", exam_name, llm), load_answers)
+
+    def human_grades(self, exam_name, llm):
+        """
+        :return: the human grades of the answers of the LLM, None if the grade file does not exist
+        """
+        path = f"human_feedback/{exam_name}/grades/{exam_name}_{self.lang}_{map_llm_to_index(llm)}_grade.json"
+        return self.load(("human_grades", exam_name, llm), lambda: load_json(path) if os.path.isfile(path) else None)
+
+    def graded_entries(self):
+        """
+        :return: list of dicts, one per human-graded answer: exam_name, llm, q (position of the question in the exam),
+        question, answer, additional info of the question, gold grade
+        """
+        entries = []
+        for additional_info_path in sorted(glob("human_feedback/*/additional_info.json")):
+            exam_name = additional_info_path.split('/')[-2]
+            if not os.path.isfile(f"exams_json/{exam_name}/{exam_name}_{self.lang}.json"):
+                continue
+            exam = self.exam(exam_name)
+            additional_info = self.additional_info(exam_name)
+            for llm in SHOT_LLM_LIST:
+                human_grades = self.human_grades(exam_name, llm)
+                if human_grades is None:
+                    continue
+                answers = self.answers(exam_name, llm)
+                for q, question in enumerate(exam['Questions']):
+                    if q >= len(human_grades['Questions']) or q >= len(additional_info['Questions']):
+                        break
+                    gold_grade = human_grades['Questions'][q]['Points']
+                    if gold_grade is None or question['Index'] not in answers:
+                        continue
+                    entries.append({
+                        "exam_name": exam_name,
+                        "llm": llm,
+                        "q": q,
+                        "question": question,
+                        "answer": answers[question['Index']],
+                        "info": additional_info['Questions'][q],
+                        "gold_grade": gold_grade
+                    })
+        return entries
+
+    def build_index(self):
+        """
+        Build the L2-normalized TF-IDF matrix of the graded answers, once per run
+        """
+        import numpy as np
+        with self.index_lock:
+            if self.matrix is not None:
+                return
+            entries = self.graded_entries()
+            documents = [tokenize(shot_text(entry["question"], entry["answer"])) for entry in entries]
+
+            document_frequency = Counter(term for document in documents for term in set(document))
+            terms = sorted(document_frequency, key=lambda term: (-document_frequency[term], term))[:self.max_features]
+            self.vocabulary = {term: i for i, term in enumerate(terms)}
+            self.idf = np.array([math.log((1 + len(documents)) / (1 + document_frequency[term])) + 1 for term in terms],
+                                dtype=np.float32)
+            self.entries = entries
+            self.entry_exams = np.array([entry["exam_name"] for entry in entries], dtype=object)
+            self.entry_llms = np.array([entry["llm"] for entry in entries], dtype=object)
+            self.matrix = tf_idf_matrix(documents, self.vocabulary, self.idf)
+            print(f"Shot corpus ({self.lang}): {len(entries)} graded answers, {len(self.vocabulary)} terms")
+
+    def nearest(self, queries, k, exclude_exam=None, exclude_llm=None):
+        """
+        Retrieve the graded answers most similar to each query, with one matrix product for all queries
+        :param queries: list of (question, answer)
+        :param exclude_exam, exclude_llm: the answers of this LLM to this exam are not retrieved (the answers being
+        graded, whose human grades must not leak into the prompt)
+        :return: per query, the list of the k nearest entries, most similar first
+        """
+        import numpy as np
+        self.build_index()
+        if len(self.entries) == 0 or len(queries) == 0:
+            return [[] for _ in queries]
+        query_matrix = tf_idf_matrix([tokenize(shot_text(question, answer)) for question, answer in queries],
+                                     self.vocabulary, self.idf)
+        scores = query_matrix @ self.matrix.T
+        if exclude_exam is not None and exclude_llm is not None:
+            scores[:, (self.entry_exams == exclude_exam) & (self.entry_llms == exclude_llm)] = -np.inf
+        k = min(k, len(self.entries))
+        # Stable sort, so that ties keep the corpus order
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return [
+            [self.entries[i] for i in row if np.isfinite(scores[query_id, i])]
+            for query_id, row in enumerate(top)
+        ]
+
+
+SHOT_CORPORA = {}
+SHOT_CORPORA_LOCK = threading.Lock()
+
+
+def shot_corpus(lang):
+    """
+    :return: the ShotCorpus of the language, shared within the process
+    """
+    with SHOT_CORPORA_LOCK:
+        if lang not in SHOT_CORPORA:
+            SHOT_CORPORA[lang] = ShotCorpus(lang)
+        return SHOT_CORPORA[lang]
+
+
+def shot_text(question, answer):
+    return f"{json.dumps(remove_key(question, 'Index'), ensure_ascii=False)}\n{answer}"
+
+
+def tokenize(text):
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def tf_idf_matrix(documents, vocabulary, idf):
+    """
+    :param documents: list of token lists
+    :return: float32 matrix of the L2-normalized TF-IDF vectors, one row per document
+    """
+    import numpy as np
+    matrix = np.zeros((len(documents), len(vocabulary)), dtype=np.float32)
+    for row, document in enumerate(documents):
+        for term, count in Counter(term for term in document if term in vocabulary).items():
+            matrix[row, vocabulary[term]] = count
+    matrix *= idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
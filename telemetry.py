@@ -0,0 +1,77 @@
+import json
+import threading
+import time
+from llm_clients import request_stats, reset_request_stats
+
+
+class Telemetry:
+    """
+    Writes one JSON record per request to a JSONL log and prints a progress line with the throughput and the ETA.
+    The totals grow as the drivers find pending requests (per exam, per candidate LLM), so the ETA covers the work
+    known so far.
+    """
+    def __init__(self, log_path=None):
+        """
+        :param log_path: JSONL file the records are appended to. None to only print the progress
+        """
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.nr_total = 0
+        self.nr_done = 0
+        self.start_time = None
+
+    def add_requests(self, nr_requests):
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+            self.nr_total += nr_requests
+
+    def send_batch(self, llm_client, requests, contexts):
+        """
+        Send the requests with `llm_client.send_batch` and measure them
+        :param contexts: one dict per request identifying it, e.g. exam, lang and question Index
+        :return: the outputs, and one record per request, to be completed by the caller (e.g. with the parse result)
+        and passed to `record`. The stats of a batch of several requests (tokens, retries, ...) are the totals of the
+        batch, see the "batch_size" field
+        """
+        reset_request_stats()
+        start_time = time.time()
+        outs = llm_client.send_batch(requests)
+        latency = time.time() - start_time
+
+        params = llm_client.cache_params()
+        records = [{
+            **context,
+            "client": params["client"],
+            "model": params.get("model"),
+            "latency": latency,
+            "batch_size": len(requests),
+            **request_stats()
+        } for context in contexts]
+        return outs, records
+
+    def record(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            if self.log_path is not None:
+                with open(self.log_path, 'a') as f:
+                    f.write(line + '\n')
+            self.nr_done += 1
+            elapsed = time.time() - self.start_time if self.start_time is not None else 0
+            throughput = self.nr_done / max(elapsed, 1e-6)
+            eta = max(self.nr_total - self.nr_done, 0) / throughput
+            print(f"[progress] {self.nr_done}/{self.nr_total} requests, {throughput:.2f} requests/s, "
+                  f"elapsed {format_seconds(elapsed)}, ETA {format_seconds(eta)}")
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def add_telemetry_arguments(parser):
+    parser.add_argument("--telemetry-log", default=None,
+                        help="JSONL file receiving one record per request (latency, tokens, images, retries, ...)")
+
+
+TELEMETRY = Telemetry()
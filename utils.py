@@ -1,10 +1,14 @@
 import json
 import os
 from PIL import Image, ImageDraw, ImageFont
-import fitz  # PyMuPDF, imported as fitz for backward compatibility reasons
 import base64
+import hashlib
 import io
 import re
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 
 LLM_LIST = ['llava', 'mistral', 'mixtral', 'qwen', 'claude', 'gpt35', 'gpt4v', 'o1-mini']
@@ -187,6 +191,24 @@ def info_from_exam_path(exam_json_path):
     return exam_name, lang
 
 
+def list_exam_json_paths(from_exam_list=False):
+    """
+    :param from_exam_list: take the exams from EXAM_LIST instead of every JSON file under exams_json/
+    :return: sorted list of exam JSON paths, e.g. exams_json/nlp_march_2023/nlp_march_2023_en.json
+    """
+    if from_exam_list:
+        paths = [
+            f"exams_json/{exam['exam_name']}/{exam['exam_name']}_{lang}.json"
+            for exam in EXAM_LIST for lang in exam['lang']
+        ]
+        return [path for path in paths if os.path.isfile(path)]
+
+    paths = []
+    for root, _, files in os.walk("exams_json"):
+        paths.extend(os.path.join(root, file) for file in files if file.endswith('.json'))
+    return sorted(paths)
+
+
 def collect_figures(question_dict):
     figure_list = []
     if 'Figures' in question_dict:
@@ -198,73 +220,226 @@ def collect_figures(question_dict):
     return figure_list
 
 
-def add_title(img, title):
-    # Create a black bar with the same width as the image and some height for the title
-    black_bar_height = 50
-    black_bar = Image.new('RGB', (img.width, black_bar_height), color='black')
+TITLE_BAR_HEIGHT = 50
 
-    # Combine the image with the black bar
-    new_img = Image.new('RGB', (img.width, img.height + black_bar_height))
+
+def add_title(img, title):
+    # Create a new image with a black bar (the default background) below the image for the title
+    new_img = Image.new('RGB', (img.width, img.height + TITLE_BAR_HEIGHT))
     new_img.paste(img, (0, 0))
-    new_img.paste(black_bar, (0, img.height))
+    draw_title(new_img, title)
+    return new_img
 
-    # Draw the title text on the black bar
-    draw = ImageDraw.Draw(new_img)
+
+def draw_title(img, title):
+    """
+    Draw the title text on the black bar at the bottom of the image
+    """
+    draw = ImageDraw.Draw(img)
     fontsize = 20
-    font = ImageFont.truetype("artifacts/Arial.ttf", size=fontsize)
+    try:
+        font = ImageFont.truetype("artifacts/Arial.ttf", size=fontsize)
+    except OSError:
+        # Not run from the repository root, e.g. the synthetic exams of the benchmarks
+        font = ImageFont.load_default(size=fontsize)
     text_width = draw.textlength(title, font=font)
     text_height = fontsize
-    text_position = ((img.width - text_width) // 2, img.height + (black_bar_height - text_height) // 2)
+    text_position = ((img.width - text_width) // 2, img.height - TITLE_BAR_HEIGHT + (TITLE_BAR_HEIGHT - text_height) // 2)
     draw.text(text_position, title, fill='white', font=font)
 
-    return new_img
 
+def fit_scale(width, height, max_long_edge=None, max_pixels=None, extra_height=0, max_short_edge=None):
+    """
+    :return: largest factor <= 1 by which a width x height image has to be scaled,
+    so that together with `extra_height` pixels added below it, it satisfies max_long_edge, max_pixels and
+    max_short_edge
+    """
+    scale = 1.0
+    if max_long_edge is not None:
+        scale = min(scale, max_long_edge / width, (max_long_edge - extra_height) / height)
+    if max_short_edge is not None:
+        # Either side may become the short one
+        scale = min(scale, max(max_short_edge / width, (max_short_edge - extra_height) / height))
+    if max_pixels is not None:
+        # Solve width * scale * (height * scale + extra_height) = max_pixels for scale
+        a, b = width * height, width * extra_height
+        scale = min(scale, (-b + (b ** 2 + 4 * a * max_pixels) ** 0.5) / (2 * a))
+    return max(scale, 0.01)
+
+
+def iter_figure_pages(path, dpi=300, title=None, max_long_edge=None, max_pixels=None, max_short_edge=None):
+    """
+    Render a figure one page at a time. Each page is rendered directly at the highest resolution up to `dpi`
+    that satisfies max_long_edge, max_pixels and max_short_edge, and the title is drawn on the same buffer,
+    so only one copy of the current page is alive at a time.
+    :param path: figure file, can be a pdf file containing multiple pages
+    :param title: if given, added to the bottom of each page as in `add_title`
+    :return: generator of PIL images
+    """
+    extra_height = TITLE_BAR_HEIGHT if title is not None else 0
+    if path.endswith('.pdf'):
+        import fitz  # PyMuPDF, imported as fitz for backward compatibility reasons. Imported here as it is slow to load
+
+        with fitz.open(path) as doc:
+            for page in doc:
+                zoom = dpi / 72  # PDF sizes are in points, 72 per inch
+                zoom = zoom * fit_scale(page.rect.width * zoom, page.rect.height * zoom,
+                                        max_long_edge, max_pixels, extra_height, max_short_edge)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))  # render page to an image
+                if title is None:
+                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                else:
+                    img = Image.new('RGB', (pix.width, pix.height + TITLE_BAR_HEIGHT))
+                    # frombuffer wraps the pixmap memory without copying it
+                    img.paste(Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1))
+                    draw_title(img, title)
+                del pix
+                yield img
+    else:
+        with Image.open(path) as img:
+            scale = fit_scale(img.width, img.height, max_long_edge, max_pixels, extra_height, max_short_edge)
+            if scale < 1:
+                img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+            else:
+                img.load()
+            yield add_title(img, title) if title is not None else img.copy()
 
-def pdf2pil(pdf_path):
-    images = []
-    doc = fitz.open(pdf_path)  # open document
-    for i, page in enumerate(doc):
-        pix = page.get_pixmap(dpi=300)  # render page to an image
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        images.append(img)
-    return images
+
+def count_pages(path):
+    if not path.endswith('.pdf'):
+        return 1
+    import fitz
+
+    with fitz.open(path) as doc:
+        return doc.page_count
 
 
-def combine_images(images):
+def pdf2pil(pdf_path, dpi=300):
+    return list(iter_figure_pages(pdf_path, dpi=dpi))
+
+
+def combine_images(images, max_pixels=None):
+    """
+    Stack the images vertically on one canvas
+    :param max_pixels: if given, the images are downscaled (one at a time, while pasting) so that the canvas fits
+    """
     # Find the maximum width and height among all images
     max_width = max(int(image.width*1.1) for image in images)
     height_gap = max(int(image.height*0.05) for image in images)
     total_height = sum(image.height for image in images) + height_gap * (len(images) + 1)
 
+    scale = fit_scale(max_width, total_height, max_pixels=max_pixels)
+    max_width, height_gap = int(max_width * scale), int(height_gap * scale)
+    sizes = [(max(1, int(image.width * scale)), max(1, int(image.height * scale))) for image in images]
+    total_height = sum(height for _, height in sizes) + height_gap * (len(images) + 1)
+
     # Create a new blank image with the maximum width and height
     combined_image = Image.new('RGB', (max_width, total_height))
 
     # Paste each image onto the blank image, padding if necessary
     y_offset = height_gap
-    for image in images:
-        x_offset = (max_width - image.width) // 2  # calculate horizontal padding
+    for image, (width, height) in zip(images, sizes):
+        if (width, height) != image.size:
+            image = image.resize((width, height), Image.LANCZOS)
+        x_offset = (max_width - width) // 2  # calculate horizontal padding
         combined_image.paste(image, (x_offset, y_offset))
-        y_offset = y_offset + image.height + height_gap
+        y_offset = y_offset + height + height_gap
 
     return combined_image
 
 
-def load_images(image_paths):
+class FigureCache:
     """
-    :param image_paths: path to the images. can be pdf file containing multiple pages
-    :return: images: list of single images loaded by PIL. images_paths_flatten: path of each single image
+    Cache of rendered figures, keyed by the hash of the figure file and the rendering parameters.
+    All pages are kept as PNG files in cache_dir, so the rasterization is shared between LLMs, grading runs,
+    processes and Streamlit reruns. Recently used pages can also be kept in memory, bounded by max_memory_bytes
+    (0, the default, disables the memory tier)
     """
-    images = []
-    images_paths_flatten = []
-    for path in image_paths:
-        if path.endswith('.pdf'):
-            images_tmp = pdf2pil(path)
-            images.extend(images_tmp)
-            images_paths_flatten.extend([path] * len(images_tmp))
+    def __init__(self, cache_dir="figure_cache", max_memory_bytes=0):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.memory = OrderedDict()  # key -> list of pages
+        self.memory_bytes = 0
+        self.file_hashes = {}  # (path, mtime, size) -> hash of the file content
+        self.lock = threading.Lock()
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        file_id = (path, stat.st_mtime_ns, stat.st_size)
+        if file_id not in self.file_hashes:
+            with open(path, 'rb') as f:
+                self.file_hashes[file_id] = hashlib.sha256(f.read()).hexdigest()
+        return self.file_hashes[file_id]
+
+    def load(self, path, dpi=300, title=None, max_long_edge=None, max_pixels=None, max_short_edge=None):
+        """
+        :return: list of the pages of the figure, see `iter_pages`
+        """
+        return list(self.iter_pages(path, dpi, title, max_long_edge, max_pixels, max_short_edge))
+
+    def iter_pages(self, path, dpi=300, title=None, max_long_edge=None, max_pixels=None, max_short_edge=None):
+        """
+        Load the pages of a figure one at a time: from memory, from the PNG files in cache_dir, or rendered with
+        `iter_figure_pages` and written to cache_dir
+        :param path: figure file, can be a pdf file containing multiple pages
+        :param title: if given, added to the bottom of each page with `add_title`
+        :param max_long_edge, max_pixels, max_short_edge: limits of the size of each page, see `iter_figure_pages`
+        :return: generator of the pages as PIL images. The images are shared with other callers and must not be
+        modified
+        """
+        key = f"{self.file_hash(path)}:{dpi}:{title}:{max_long_edge}:{max_pixels}"
+        if max_short_edge is not None:
+            # Only when given, so that the pages cached before the short edge limit stay valid
+            key += f":{max_short_edge}"
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        with self.lock:
+            images = self.memory.get(key)
+            if images is not None:
+                self.memory.move_to_end(key)
+        if images is not None:
+            yield from images
+            return
+
+        # Without a memory tier, no page is kept after it is handed out
+        images = [] if self.max_memory_bytes > 0 else None
+        key_dir = f"{self.cache_dir}/{key[:2]}/{key}"
+        if os.path.isfile(f"{key_dir}/pages.json"):
+            nr_pages = load_json(f"{key_dir}/pages.json")["NrPages"]
+            for page in range(nr_pages):
+                with Image.open(f"{key_dir}/{page}.png") as img:
+                    img = img.copy()
+                if images is not None:
+                    images.append(img)
+                yield img
         else:
-            images.append(Image.open(path))
-            images_paths_flatten.append(path)
-    return images, images_paths_flatten
+            os.makedirs(key_dir, exist_ok=True)
+            nr_pages = 0
+            for page, img in enumerate(iter_figure_pages(path, dpi, title, max_long_edge, max_pixels, max_short_edge)):
+                tmp_path = f"{key_dir}/{page}.{os.getpid()}.{threading.get_ident()}.tmp.png"
+                img.save(tmp_path, format='PNG')
+                os.replace(tmp_path, f"{key_dir}/{page}.png")
+                nr_pages += 1
+                if images is not None:
+                    images.append(img)
+                yield img
+            # Written last: marks the entry as complete
+            dump_json({"NrPages": nr_pages}, f"{key_dir}/pages.json")
+
+        if images is not None:
+            with self.lock:
+                if key not in self.memory:
+                    self.memory[key] = images
+                    self.memory_bytes += image_bytes(images)
+                while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 0:
+                    _, evicted_images = self.memory.popitem(last=False)
+                    self.memory_bytes -= image_bytes(evicted_images)
+
+
+def image_bytes(images):
+    return sum(img.width * img.height * len(img.getbands()) for img in images)
+
+
+FIGURE_CACHE = FigureCache()
 
 
 def write_text_file(string, file_path):
@@ -272,6 +447,41 @@ def write_text_file(string, file_path):
         file.write(string)
 
 
+JOURNAL_LOCK = threading.Lock()
+
+
+def load_journal(file_path):
+    """
+    Load an append-only journal of per-question records written by `append_journal`
+    :return: dict mapping the question Index to its record. Empty if the journal does not exist
+    """
+    records = {}
+    if not os.path.isfile(file_path):
+        return records
+    with open(file_path, 'r') as f:
+        content = f.read()
+    if content and not content.endswith('\n'):
+        # The last record was cut off by a crash. Drop it so that new records start on a clean line
+        content = content[:content.rfind('\n') + 1]
+        write_text_file(content, file_path)
+    for line in content.splitlines():
+        if line.strip():
+            record = json.loads(line)
+            records[record['Index']] = record
+    return records
+
+
+def append_journal(record, file_path):
+    """
+    Append a single per-question record to the journal. Safe to call from multiple threads
+    """
+    with JOURNAL_LOCK:
+        with open(file_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
 def encode_image(image_path=None, pil_image=None):
     if image_path is not None:
         with open(image_path, "rb") as image_file:
@@ -288,30 +498,264 @@ def encode_image(image_path=None, pil_image=None):
         return encoded_image
 
 
-def process_images(exam_name, question):
-    image_paths = collect_figures(question)
-    image_full_paths = [f"exams_json/{exam_name}/{x}" for x in image_paths]
-    images, image_full_paths_flatten = load_images(image_full_paths)
-    image_paths_flatten = [path.replace(f"exams_json/{exam_name}/", "") for path in image_full_paths_flatten]
-    image_titles = [f"Figure: {x}" for x in image_paths_flatten]
-    images = [add_title(img, title) for img, title in zip(images, image_titles)]
+class ImagePolicy:
+    """
+    How images are prepared for an LLM provider before base64 encoding:
+    downscaled to at most max_long_edge pixels / max_megapixels and to a short edge of at most max_short_edge pixels,
+    encoded as PNG, JPEG or WEBP (quality for the lossy formats), and further downscaled until all images of a request
+    fit into max_request_bytes of base64
+    """
+    def __init__(self, max_long_edge=None, max_megapixels=None, image_format='PNG', quality=85,
+                 max_request_bytes=None, max_short_edge=None):
+        if image_format not in ['PNG', 'JPEG', 'WEBP']:
+            raise RuntimeError(f"Image format {image_format} not supported")
+        self.max_long_edge = max_long_edge
+        self.max_short_edge = max_short_edge
+        self.max_megapixels = max_megapixels
+        self.image_format = image_format
+        self.quality = quality
+        self.max_request_bytes = max_request_bytes
+
+    @property
+    def media_type(self):
+        return f"image/{self.image_format.lower()}"
+
+    def describe(self):
+        description = {
+            "max_long_edge": self.max_long_edge,
+            "max_megapixels": self.max_megapixels,
+            "image_format": self.image_format,
+            "quality": self.quality,
+            "max_request_bytes": self.max_request_bytes
+        }
+        # Only when set, so that the cached responses of the policies without it stay valid
+        if self.max_short_edge is not None:
+            description["max_short_edge"] = self.max_short_edge
+        return description
+
+    def scale(self, pil_image):
+        """
+        :return: factor <= 1 by which the image has to be downscaled to satisfy the size limits
+        """
+        scale = 1.0
+        if self.max_long_edge is not None:
+            scale = min(scale, self.max_long_edge / max(pil_image.width, pil_image.height))
+        if self.max_short_edge is not None:
+            scale = min(scale, self.max_short_edge / min(pil_image.width, pil_image.height))
+        if self.max_megapixels is not None:
+            scale = min(scale, (self.max_megapixels * 1e6 / (pil_image.width * pil_image.height)) ** 0.5)
+        return scale
+
+
+# Sizes the vision models actually consume: OpenAI scales images to fit 2048x2048, then scales them down so that
+# the short side is at most 768 pixels. Claude scales them to a long edge of 1568 pixels / ~1.15 megapixels
+OPENAI_IMAGE_POLICY = ImagePolicy(max_long_edge=2048, max_short_edge=768, max_request_bytes=20 * 1024 ** 2)
+CLAUDE_IMAGE_POLICY = ImagePolicy(max_long_edge=1568, max_megapixels=1.15, max_request_bytes=20 * 1024 ** 2)
+
+ENCODED_IMAGE_CACHE = OrderedDict()  # (image digest, format, quality, width, height) -> base64 string
+ENCODED_IMAGE_CACHE_MAX_BYTES = 256 * 1024 ** 2
+ENCODED_IMAGE_CACHE_BYTES = 0  # total length of the base64 strings in ENCODED_IMAGE_CACHE
+ENCODED_IMAGE_CACHE_LOCK = threading.Lock()
+
+
+def encode_images(images, policy):
+    """
+    Downscale and encode the images of a request according to the policy
+    :return: list of base64 strings, one per image
+    """
+    digests = [image_digest(image) for image in images]
+    scales = [policy.scale(image) for image in images]
+    for _ in range(8):
+        encoded_images = [
+            encode_image_cached(image, digest, policy, scale) for image, digest, scale in zip(images, digests, scales)
+        ]
+        total_bytes = sum(len(encoded_image) for encoded_image in encoded_images)
+        if policy.max_request_bytes is None or total_bytes <= policy.max_request_bytes:
+            return encoded_images
+        # Encoded size is roughly proportional to the number of pixels
+        shrink = 0.9 * (policy.max_request_bytes / total_bytes) ** 0.5
+        scales = [scale * shrink for scale in scales]
+    raise RuntimeError(f"Could not fit {len(images)} images into {policy.max_request_bytes} bytes")
+
+
+def encode_image_cached(pil_image, digest, policy, scale):
+    width = max(1, int(pil_image.width * scale))
+    height = max(1, int(pil_image.height * scale))
+    key = (digest, policy.image_format, policy.quality, width, height)
+    with ENCODED_IMAGE_CACHE_LOCK:
+        if key in ENCODED_IMAGE_CACHE:
+            ENCODED_IMAGE_CACHE.move_to_end(key)
+            return ENCODED_IMAGE_CACHE[key]
+
+    if (width, height) != pil_image.size:
+        pil_image = pil_image.resize((width, height), Image.LANCZOS)
+    if policy.image_format == 'JPEG' and pil_image.mode != 'RGB':
+        pil_image = pil_image.convert('RGB')
+    image_stream = io.BytesIO()
+    if policy.image_format == 'PNG':
+        pil_image.save(image_stream, format='PNG')
+    else:
+        pil_image.save(image_stream, format=policy.image_format, quality=policy.quality)
+    encoded_image = base64.b64encode(image_stream.getvalue()).decode('utf-8')
+
+    add_encoded_images([(key, encoded_image)])
+    return encoded_image
+
+
+def add_encoded_images(entries):
+    """
+    :param entries: list of (key, base64 string) to add to ENCODED_IMAGE_CACHE
+    """
+    global ENCODED_IMAGE_CACHE_BYTES
+    with ENCODED_IMAGE_CACHE_LOCK:
+        for key, encoded_image in entries:
+            if key in ENCODED_IMAGE_CACHE:
+                ENCODED_IMAGE_CACHE_BYTES -= len(ENCODED_IMAGE_CACHE[key])
+            ENCODED_IMAGE_CACHE[key] = encoded_image
+            ENCODED_IMAGE_CACHE_BYTES += len(encoded_image)
+        while ENCODED_IMAGE_CACHE_BYTES > ENCODED_IMAGE_CACHE_MAX_BYTES and len(ENCODED_IMAGE_CACHE) > 1:
+            _, evicted_image = ENCODED_IMAGE_CACHE.popitem(last=False)
+            ENCODED_IMAGE_CACHE_BYTES -= len(evicted_image)
+
+
+def image_digest(pil_image):
+    """
+    :return: hex digest of the pixel content of the image
+    """
+    digest = hashlib.sha256(f"{pil_image.mode}:{pil_image.width}x{pil_image.height}:".encode('utf-8'))
+    digest.update(pil_image.tobytes())
+    return digest.hexdigest()
+
+
+def process_images(exam_name, question, image_policy=None, max_megapixels=None, encode=True):
+    """
+    :param image_policy: if given, figures are rendered directly at the resolution the provider consumes
+    :param max_megapixels: if given, the total size of all figure pages of the question, which bounds the memory
+    :param encode: whether to encode the pages for the image policy; if False, the request encodes them when it is sent
+    :return: list of the (titled) pages of all figures of the question. Rendered pages are cached in FIGURE_CACHE
+    """
+    image_paths = [f"exams_json/{exam_name}/{x}" for x in collect_figures(question)]
+    max_long_edge, max_pixels, max_short_edge = None, None, None
+    if image_policy is not None:
+        max_long_edge = image_policy.max_long_edge
+        max_short_edge = image_policy.max_short_edge
+        max_pixels = image_policy.max_megapixels * 1e6 if image_policy.max_megapixels is not None else None
+    if max_megapixels is not None and len(image_paths) > 0:
+        # Share the budget equally between the pages
+        page_pixels = max_megapixels * 1e6 / sum(count_pages(path) for path in image_paths)
+        max_pixels = page_pixels if max_pixels is None else min(max_pixels, page_pixels)
+
+    # One page at a time: rendered (or read from the disk cache) and, for an image policy, encoded before the next
+    # page is loaded. The request reuses the encodings from ENCODED_IMAGE_CACHE
+    images = []
+    for image_path in image_paths:
+        for page in FIGURE_CACHE.iter_pages(
+                image_path,
+                title=f"Figure: {image_path.replace(f'exams_json/{exam_name}/', '')}",
+                max_long_edge=max_long_edge,
+                max_pixels=max_pixels,
+                max_short_edge=max_short_edge
+        ):
+            if encode and image_policy is not None:
+                encode_images([page], image_policy)
+            images.append(page)
     return images
 
 
-def extract_answer(question_id, answer):
-    start_marker = f"Answer to Question {question_id}"
-    end_marker = "****************************************************************************************\n" \
-                 "****************************************************************************************"
+# Default budget of the rendered figures of a question: above what the vision models consume
+# (OpenAI: at most 768x2048 per image, Claude: ~1.15 megapixels per image),
+# and far below the ~38 megapixels of a single A4 page at 300 dpi
+FIGURE_MAX_MEGAPIXELS = 8.0
+
+
+def add_figure_arguments(parser):
+    parser.add_argument("--figure-max-megapixels", default=FIGURE_MAX_MEGAPIXELS, type=float,
+                        help="Bound on the total size of the rendered figures of a question")
+    parser.add_argument("--figure-cache-memory-mb", default=0, type=int,
+                        help="Rendered figure pages kept in memory in addition to the disk cache. 0 to disable")
+    parser.add_argument("--prefetch-workers", default=2, type=int,
+                        help="Processes rendering the figures of upcoming questions ahead of the requests. 0 to disable")
+    parser.add_argument("--prefetch-lookahead", default=4, type=int,
+                        help="Number of questions whose figures are prefetched ahead")
+
+
+def prefetch_figures(exam_name, question, image_policy, max_megapixels):
+    """
+    Runs in a FigurePrefetcher worker process: only renders the figures of the question (or reads them from the disk
+    cache). The worker keeps no pages or encodings in memory: its FIGURE_CACHE has the default memory tier of 0, and
+    the pages are encoded by the client when the request is sent
+    :return: the pages
+    """
+    return process_images(exam_name, question, image_policy=image_policy, max_megapixels=max_megapixels,
+                          encode=False)
+
 
-    start_index = answer.find(start_marker)
-    if start_index == -1:
-        raise RuntimeError(f"Problem with extracting answer for question {question_id}")
+def create_prefetch_pool(max_workers):
+    """
+    Created once per process and shared by the FigurePrefetchers of all exams
+    :return: process pool for FigurePrefetcher, or None if max_workers is 0
+    """
+    if max_workers == 0:
+        return None
+    # spawn instead of fork: the pool is created while other threads (e.g. of sciex.py) may be running
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
 
-    end_index = answer.find(end_marker, start_index)
-    if end_index == -1:
-        raise RuntimeError(f"Problem with extracting answer for question {question_id}")
 
-    return answer[start_index + len(start_marker):end_index]
+class FigurePrefetcher:
+    """
+    Renders the figures of upcoming questions in a process pool while earlier requests are in flight.
+    At most `lookahead` questions beyond the last requested one are prefetched.
+    Without a pool, the figures are rendered when requested.
+    """
+    def __init__(self, pool, exam_name, questions, image_policy=None, max_megapixels=None, lookahead=4,
+                 consumes_images=True):
+        """
+        :param questions: the questions in the order their figures will be requested with `get`
+        :param consumes_images: if False (the client only sends text), no figures are rendered and `get` returns []
+        """
+        self.pool = pool if consumes_images else None
+        self.consumes_images = consumes_images
+        self.exam_name = exam_name
+        self.questions = questions
+        self.image_policy = image_policy
+        self.max_megapixels = max_megapixels
+        self.lookahead = lookahead
+        self.futures = {}
+        self.nr_submitted = 0
+        self.lock = threading.Lock()
+
+    def get(self, i):
+        """
+        :return: the images of the i-th question, as returned by `process_images`
+        """
+        if not self.consumes_images:
+            return []
+        if self.pool is None:
+            return process_images(self.exam_name, self.questions[i], self.image_policy, self.max_megapixels)
+
+        with self.lock:
+            if i not in self.futures and i < self.nr_submitted:
+                # Requested a second time
+                self.futures[i] = self.submit(i)
+            while self.nr_submitted < min(i + self.lookahead + 1, len(self.questions)):
+                self.futures[self.nr_submitted] = self.submit(self.nr_submitted)
+                self.nr_submitted += 1
+            future = self.futures.pop(i)
+
+        return future.result()
+
+    def submit(self, i):
+        return self.pool.submit(prefetch_figures, self.exam_name, self.questions[i], self.image_policy,
+                                self.max_megapixels)
+
+    def cancel(self):
+        """
+        Cancel the prefetches that are not started yet, e.g. when the exam failed. The shared pool keeps running
+        """
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
 
 
 def parse_grade(llm_out, max_score):
@@ -1,6 +1,6 @@
 import os.path
 
-from pydantic import BaseModel, ValidationError, model_validator, field_validator
+from pydantic import BaseModel, ValidationError, ValidationInfo, model_validator, field_validator
 from typing import Optional, List, Any
 import argparse
 from utils import load_json
@@ -15,6 +15,17 @@ def report_extra_field_static(cls, data):
         print(f"Extra keys: {extra_keys}")
 
 
+def check_figure_paths(figure_paths, info):
+    """
+    :param info: validation info, whose context holds the directory of the exam ("dir_path")
+    """
+    for figure_path in figure_paths:
+        path = f"{info.context['dir_path']}/{figure_path}"
+        if not os.path.isfile(path):
+            raise RuntimeError(f"Figure path {path} not exists")
+    return figure_paths
+
+
 class Subquestion(BaseModel):
     Index: str
     Content: str
@@ -28,12 +39,8 @@ class Subquestion(BaseModel):
 
     @field_validator('Figures')
     @classmethod
-    def figure_paths_must_exist(cls, v):
-        for figure_path in v:
-            path = f"{dir_path}/{figure_path}"
-            if not os.path.isfile(path):
-                raise RuntimeError(f"Figure path {path} not exists")
-        return v
+    def figure_paths_must_exist(cls, v, info: ValidationInfo):
+        return check_figure_paths(v, info)
 
 
 class Question(BaseModel):
@@ -51,12 +58,8 @@ class Question(BaseModel):
 
     @field_validator('Figures')
     @classmethod
-    def figure_paths_must_exist(cls, v):
-        for figure_path in v:
-            path = f"{dir_path}/{figure_path}"
-            if not os.path.isfile(path):
-                raise RuntimeError(f"Figure path {path} not exists")
-        return v
+    def figure_paths_must_exist(cls, v, info: ValidationInfo):
+        return check_figure_paths(v, info)
 
 
 class Exam(BaseModel):
@@ -76,13 +79,17 @@ def main():
     args = parser.parse_args()
     print(args)
 
-    global dir_path
-    dir_path = '/'.join(args.json_path.split("/")[:-1])
-    exam = load_json(args.json_path)
+    validate_exam(args.json_path)
+
+
+def validate_exam(json_path):
+    dir_path = '/'.join(json_path.split("/")[:-1])
+    exam = load_json(json_path)
 
     try:
-        # Validate JSON data against Pydantic model
-        validated_data = Exam(**exam)
+        # Validate JSON data against Pydantic model. The exam directory is passed in the validation context, so that
+        # exams can be validated in parallel threads
+        validated_data = Exam.model_validate(exam, context={"dir_path": dir_path})
         print("JSON data is valid!")
     except ValidationError as e:
         print("JSON data is not valid:", e)